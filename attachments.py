@@ -0,0 +1,30 @@
+import gzip
+import io
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from sandbox import CapturedImage
+
+# longest output shown in the embed itself, Discord caps a field at 1024 characters including the code block around it
+FIELD_LIMIT = 1000
+
+
+def encode_png(image: CapturedImage) -> bytes:
+    """Encode an image a snippet showed as a PNG"""
+    buffer = io.BytesIO()
+    Image.frombuffer(image.mode, (image.width, image.height), image.pixels, "raw", image.mode, 0, 1).save(
+        buffer, format="PNG", compress_level=6)
+    return buffer.getvalue()
+
+
+def render(images: List[CapturedImage], output: str) -> Tuple[List[Tuple[str, bytes]], Optional[str]]:
+    """Encode a snippet's images, and its output if it is too long for the embed, as (filename, data) attachments,
+    returning them with the output to show in the embed. Slow enough to belong on a thread"""
+    files = [(f"image{i}.png", encode_png(image)) for i, image in enumerate(images, start=1)]
+    if len(output) <= FIELD_LIMIT:
+        return files, output
+
+    files.append(("output.txt.gz", gzip.compress(output.encode(), compresslevel=6)))
+    preview = output[:FIELD_LIMIT - 60].rstrip("\n")
+    return files, f"{preview}\n... (the full output is attached as output.txt.gz)"
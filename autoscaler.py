@@ -0,0 +1,170 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+import psutil
+
+from scheduler import Scheduler
+
+# cgroup v2 and v1 files holding the container's memory limit, usage and statistics, and the statistic counting
+# page cache that can be reclaimed
+_CGROUP_V2 = ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.stat",
+              "inactive_file")
+_CGROUP_V1 = ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+              "/sys/fs/cgroup/memory/memory.stat", "total_inactive_file")
+
+# cgroup v1 reports "no limit" as a huge number rather than "max"
+_UNLIMITED = 1 << 60
+
+
+def _read_stat(stat_path: str, key: str) -> int:
+    """A value from a cgroup's memory.stat, 0 if it isn't there"""
+    try:
+        with open(stat_path) as f:
+            for line in f:
+                name, _, value = line.partition(" ")
+                if name == key:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _read_cgroup(limit_path: str, usage_path: str, stat_path: str, inactive_key: str) -> Optional[Tuple[int, int]]:
+    try:
+        with open(limit_path) as f:
+            limit = f.read().strip()
+        with open(usage_path) as f:
+            usage = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    if limit == "max" or int(limit) >= _UNLIMITED:
+        return None
+
+    # Usage includes the page cache of the logs and of the mapped libraries, which the kernel reclaims before it
+    # kills anything, so leave out the inactive part as docker stats and the kubelet do
+    return int(limit), max(usage - _read_stat(stat_path, inactive_key), 0)
+
+
+def memory_budget() -> Tuple[int, int]:
+    """The memory limit and usage of the container, not counting reclaimable page cache, or of the host when the
+    container has no limit"""
+    for paths in (_CGROUP_V2, _CGROUP_V1):
+        budget = _read_cgroup(*paths)
+        if budget is not None:
+            return budget
+    memory = psutil.virtual_memory()
+    return memory.total, memory.total - memory.available
+
+
+@dataclass(frozen=True)
+class ScalingDecision:
+    """A change of the pool's size and what led to it"""
+    time: float
+    old_size: int
+    new_size: int
+    reason: str
+
+
+class Autoscaler:
+    """Grows the pool while snippets queue up and memory allows, and shrinks it when it sits idle or memory runs low"""
+
+    def __init__(self, scheduler: Scheduler, min_size: int = 1, max_size: int = 8, interval: float = 5,
+                 target_wait: float = 1.0, idle_period: float = 60, worker_memory: Optional[int] = None,
+                 reserve: float = 0.1, on_decision: Optional[Callable[[ScalingDecision], None]] = None):
+        self.scheduler = scheduler
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interval = interval
+        # queue wait past which snippets are waiting too long
+        self.target_wait = target_wait
+        # how long the pool has to go without queueing before a worker is retired
+        self.idle_period = idle_period
+        # memory to set aside for each worker, by default the most a snippet may use
+        self.worker_memory = worker_memory or scheduler.pool.limits.memory
+        # share of the memory limit that is never handed to new workers
+        self.reserve = reserve
+        self.on_decision = on_decision
+        self.decisions = deque(maxlen=50)
+        self.headroom = 0
+
+        # (time, queue wait) of recently finished snippets
+        self._waits = deque(maxlen=100)
+        self._last_busy = time.monotonic()
+        self._last_change = 0.0
+        self._task = None
+
+    def observe(self, queue_wait: float):
+        """Record how long a snippet waited for a worker"""
+        self._waits.append((time.monotonic(), queue_wait))
+
+    def _recent_wait(self, now: float) -> float:
+        """The longest queue wait of the snippets that finished within the last interval"""
+        return max((wait for at, wait in self._waits if at >= now - self.interval), default=0.0)
+
+    def decide(self) -> Tuple[int, str]:
+        """Work out the size the pool should have now, and why"""
+        pool = self.scheduler.pool
+        size = pool.size
+        now = time.monotonic()
+        limit, usage = memory_budget()
+        self.headroom = limit - usage - int(limit * self.reserve)
+        queued = self.scheduler.queued
+        wait = self._recent_wait(now)
+        if queued or pool.busy >= size:
+            self._last_busy = now
+
+        # Memory comes first, a worker too many risks the whole container being killed
+        if self.headroom < 0 and size > self.min_size:
+            return size - 1, f"memory headroom {self.headroom / 2 ** 20:.0f}MB below the reserve"
+
+        # Add as many workers as are waited for and fit in memory
+        if (queued or wait > self.target_wait) and size < self.max_size:
+            fits = self.headroom // self.worker_memory
+            wanted = min(max(queued, 1), self.max_size - size, fits)
+            if wanted > 0:
+                return size + wanted, f"{queued} queued, recent wait {wait:.2f}s"
+
+        # Give a worker back after a quiet period, one at a time
+        if size > self.min_size and now - max(self._last_busy, self._last_change) >= self.idle_period:
+            return size - 1, f"no queueing for {self.idle_period:.0f}s"
+
+        # Keep within bounds that may have been changed since
+        if size < self.min_size or size > self.max_size:
+            return max(self.min_size, min(size, self.max_size)), "outside the configured bounds"
+        return size, ""
+
+    def step(self) -> Optional[ScalingDecision]:
+        """Resize the pool if it should be, returning the decision taken"""
+        old_size = self.scheduler.pool.size
+        new_size, reason = self.decide()
+        if new_size == old_size:
+            return None
+
+        self.scheduler.resize(new_size)
+        self._last_change = time.monotonic()
+        decision = ScalingDecision(time.time(), old_size, new_size, reason)
+        self.decisions.append(decision)
+        if self.on_decision is not None:
+            self.on_decision(decision)
+        return decision
+
+    async def _run(self):
+        while True:
+            try:
+                self.step()
+            except (psutil.Error, OSError):
+                # Try again on the next tick
+                pass
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start scaling in the background, doing nothing if it is already running"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
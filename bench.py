@@ -0,0 +1,288 @@
+"""Offline benchmark of the interpreter pipeline.
+
+Replays a corpus of representative snippets through the real on_message handler against fake Discord
+objects, then reports throughput, latency percentiles, peak memory and the snippets that failed, and saves
+them as JSON so that runs can be compared:
+
+    python bench.py --concurrency 8 --requests 200 --output bench_output.json
+    python bench.py --compare bench_output.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import psutil
+
+# representative snippets, by category
+CORPUS = {
+    "trivial": [
+        "print('hello, world!')",
+        "print(2 ** 10)",
+        "name = 'duck'\nprint(name.upper(), len(name))",
+    ],
+    "numpy": [
+        "import numpy\na = numpy.arange(100000)\nprint(a.dot(a), numpy.add.reduce(a))",
+        "import numpy\nm = numpy.ones((200, 200))\nprint(m.dot(m).trace())",
+    ],
+    "pandas": [
+        "import pandas\ndf = pandas.DataFrame({'a': range(1000), 'b': range(1000)})\nprint(df.describe())",
+        "import pandas\ndf = pandas.DataFrame({'k': [i % 7 for i in range(5000)], 'v': range(5000)})\n"
+        "print(df.groupby('k').sum())",
+    ],
+    "cpu": [
+        "x = 0\nfor i in range(300000):\n    x = x + i * i\nprint(x)",
+        "def fib(n):\n    return n if n < 2 else fib(n - 1) + fib(n - 2)\nprint(fib(20))",
+    ],
+    "timeout": [
+        "i = 0\nwhile i >= 0:\n    i = i + 1",
+    ],
+    "large_output": [
+        "for i in range(5000):\n    print('line', i)",
+        "print('x' * 200000)",
+    ],
+}
+
+# how often each category comes up, roughly what a class sends
+WEIGHTS = {"trivial": 40, "numpy": 15, "pandas": 10, "cpu": 20, "timeout": 2, "large_output": 13}
+
+# how the bot's reply says a snippet didn't run cleanly, by outcome
+FAILURES = {
+    "error": "Runtime error: ",
+    "timeout": "Timeout error - ",
+    "cpu_limit": "CPU limit exceeded - ",
+    "memory_limit": "Memory limit exceeded - ",
+    "preflight": "Rejected before running - ",
+    "rejected": "Too many snippets are waiting to run",
+}
+
+
+class FakeUser:
+    # Marked as a bot, so process_commands skips the message without needing a connection
+    bot = True
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f"student{user_id}"
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.name = f"class-{channel_id}"
+
+    def __str__(self):
+        return self.name
+
+
+class FakeSentMessage:
+    """Stands in for the reply the bot edits, keeping every embed it is given"""
+
+    def __init__(self, channel: FakeChannel, embed):
+        self.channel = channel
+        self.embeds = [embed]
+        self.edits = 0
+
+    async def edit(self, embed=None, **kwargs):
+        self.embeds.append(embed)
+        self.edits += 1
+
+
+class FakeMessage:
+    """Stands in for a Discord message sent to the bot"""
+
+    def __init__(self, content: str, author: FakeUser, channel: FakeChannel):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.sent = None
+
+    async def reply(self, embed=None, **kwargs):
+        self.sent = FakeSentMessage(self.channel, embed)
+        return self.sent
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "mean": statistics.fmean(values),
+            "max": values[-1]}
+
+
+def outcome(message: FakeMessage) -> str:
+    """The outcome of a snippet, read from the output in the bot's final reply"""
+    output = message.sent.embeds[-1].fields[1].value
+    for name, text in FAILURES.items():
+        if text in output:
+            return name
+    return "ok"
+
+
+def tree_rss() -> int:
+    """RSS of this process and all of its children, which includes the sandbox workers"""
+    process = psutil.Process()
+    total = 0
+    for p in [process, *process.children(recursive=True)]:
+        try:
+            total += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+async def sample_rss(peak: dict, interval: float = 0.05):
+    while True:
+        peak["rss"] = max(peak["rss"], tree_rss())
+        await asyncio.sleep(interval)
+
+
+async def run_benchmark(main, requests: int, concurrency: int, users: int, channels: int, unique: bool,
+                        seed: int, only: str = None) -> dict:
+    rng = random.Random(seed)
+    weights = {category: weight for category, weight in WEIGHTS.items() if only in (None, category)}
+    categories = rng.choices(list(weights), weights=list(weights.values()), k=requests)
+    plan = []
+    for i, category in enumerate(categories):
+        source = rng.choice(CORPUS[category])
+
+        # A unique comment defeats the compile and result caches
+        if unique:
+            source += f"\n# request {i}"
+        plan.append((category, source, FakeUser(rng.randrange(users)), FakeChannel(rng.randrange(channels))))
+
+    latencies = {category: [] for category in CORPUS}
+    failures = {category: {} for category in CORPUS}
+    edits = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(category, source, author, channel):
+        nonlocal edits
+        async with semaphore:
+            message = FakeMessage(f">> {source}", author, channel)
+            start = time.perf_counter()
+            await main.on_message(message)
+            latencies[category].append(time.perf_counter() - start)
+            edits += message.sent.edits
+
+            # A snippet that fails for the wrong reason makes its latency meaningless, so count those
+            result = outcome(message)
+            if result != "ok":
+                failures[category][result] = failures[category].get(result, 0) + 1
+
+    peak = {"rss": tree_rss()}
+    sampler = asyncio.ensure_future(sample_rss(peak))
+    start = time.perf_counter()
+    await asyncio.gather(*(send(*request) for request in plan))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+
+    every = [latency for values in latencies.values() for latency in values]
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "throughput": requests / elapsed,
+        "latency": percentiles(every),
+        "latency_by_category": {category: percentiles(values) for category, values in latencies.items() if values},
+        "failures_by_category": {category: counts for category, counts in failures.items() if counts},
+        "peak_rss": peak["rss"],
+        "edits": edits,
+    }
+
+
+def print_report(results: dict, previous: dict = None):
+    def compare(path):
+        if previous is None:
+            return ""
+        old = previous
+        new = results
+        for key in path:
+            old = old.get(key, {}) if isinstance(old, dict) else {}
+            new = new[key]
+        if not isinstance(old, (int, float)) or not old:
+            return ""
+        return f" ({(new - old) / old * 100:+.1f}%)"
+
+    print(f"{results['requests']} requests at concurrency {results['concurrency']} "
+          f"in {results['elapsed']:.2f}s")
+    print(f"throughput: {results['throughput']:.2f} req/s{compare(['throughput'])}")
+    print(f"peak RSS:   {results['peak_rss'] / 1024 ** 2:.1f}MB{compare(['peak_rss'])}")
+    print(f"{'category':<14}{'p50':>10}{'p95':>10}{'p99':>10}")
+    rows = [("all", results["latency"], ["latency"])]
+    rows += [(category, values, ["latency_by_category", category])
+             for category, values in results["latency_by_category"].items()]
+    for name, values, path in rows:
+        print(f"{name:<14}" + "".join(f"{values[q] * 1000:>8.1f}ms" for q in ("p50", "p95", "p99"))
+              + compare(path + ["p95"]))
+    for category, counts in results["failures_by_category"].items():
+        print(f"{category} didn't run cleanly: " + ", ".join(f"{count} {name}" for name, count in counts.items()))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the interpreter pipeline offline.")
+    parser.add_argument("--requests", type=int, default=100, help="number of snippets to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="snippets in flight at once")
+    parser.add_argument("--users", type=int, default=20, help="number of distinct fake users")
+    parser.add_argument("--channels", type=int, default=3, help="number of distinct fake channels")
+    parser.add_argument("--timeout", type=float, default=None, help="override the per-snippet timeout")
+    parser.add_argument("--unique", action="store_true", help="make every snippet unique to bypass the caches")
+    parser.add_argument("--no-fast-path", action="store_true", help="send trivial snippets to the sandbox too")
+    parser.add_argument("--only", choices=sorted(CORPUS), default=None, help="only send snippets of this category")
+    parser.add_argument("--seed", type=int, default=0, help="seed for picking snippets")
+    parser.add_argument("--output", default=None, help="save the results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="compare against results saved by an earlier run")
+    args = parser.parse_args()
+
+    # Keep the benchmark's logs away from the real ones
+    os.environ.setdefault("LOG_FORMAT", "text")
+    import main
+
+    main.log_writer.location = tempfile.mkdtemp(prefix="rubber_duck_bench_")
+    if args.timeout is not None:
+        main.pool.timeout = args.timeout
+    main.fast_path_enabled = not args.no_fast_path
+
+    # The bot logs every snippet to the console, which would bury the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = asyncio.run(run_benchmark(main, args.requests, args.concurrency, args.users, args.channels,
+                                            args.unique, args.seed, args.only))
+        main.log_writer.close()
+
+    results["date"] = datetime.now().isoformat(timespec="seconds")
+    results["python"] = platform.python_version()
+    results["cpus"] = os.cpu_count()
+    results["fast_path"] = main.fast_path_enabled
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    main.pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
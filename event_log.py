@@ -0,0 +1,253 @@
+import atexit
+import json
+import os
+import queue
+import re
+import sys
+import threading
+from datetime import datetime
+
+
+# every day directory holds its log as one or more segments: log.1.<ext>, log.2.<ext>, ... and the current log.<ext>,
+# plus index.tsv (segment, byte offset, length, type and user of each entry) and summary.json (entry counts per
+# type and per user), which let searches skip days and seek straight to matching entries
+_SEGMENT_PATTERN = re.compile(r"log\.(\d+)\.(txt|jsonl)$")
+
+
+def _last_segment(log_dir: str, extension: str) -> int:
+    """Number of the newest segment that has been moved aside, 0 if there are none"""
+    numbers = [int(match.group(1)) for match in map(_SEGMENT_PATTERN.match, os.listdir(log_dir))
+               if match and match.group(2) == extension]
+    return max(numbers, default=0)
+
+
+class LogWriter:
+    """Writes log entries in batches from a background thread, one directory per day and rotated by size"""
+
+    def __init__(self, location: str, fmt: str = "text", max_bytes: int = 10 * 1024 * 1024,
+                 flush_interval: float = 1.0, batch_size: int = 256):
+        if fmt not in ("text", "jsonl"):
+            raise ValueError(f"unknown log format {fmt!r}")
+
+        self.location = location
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+
+        # state of the day currently being written to, only touched by the writer thread
+        self._days = {}
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+        # Make sure buffered entries still reach the disk when the bot shuts down
+        atexit.register(self.close)
+
+    @property
+    def extension(self) -> str:
+        return "txt" if self.fmt == "text" else "jsonl"
+
+    def write(self, event_type: str, message: str, **fields):
+        """Queue an entry for the writer thread, the caller never waits on the disk"""
+        self._queue.put((datetime.now(), event_type, message, fields))
+
+    def _format(self, now: datetime, event_type: str, message: str, fields: dict) -> str:
+        if self.fmt == "jsonl":
+            entry = {"time": now.isoformat(timespec="milliseconds"), "type": event_type, "message": message}
+            entry.update(fields)
+            return json.dumps(entry) + "\n"
+        return f"[{now.strftime('%Y-%m-%d %H:%M:%S')}] -|{event_type.upper()}|- {message}\n"
+
+    def _open_day(self, day: str) -> dict:
+        """Load what the writer tracks for a day: its current file's segment number and the index summary"""
+        state = self._days.get(day)
+        if state is not None:
+            return state
+
+        # Construct the directory path and ensure it exists
+        log_dir = f"{self.location}/{day}"
+        os.makedirs(log_dir, exist_ok=True)
+
+        # Pick up where a previous run of the bot left off
+        summary = {"types": {}, "users": {}}
+        if os.path.exists(f"{log_dir}/summary.json"):
+            with open(f"{log_dir}/summary.json") as f:
+                summary = json.load(f)
+
+        state = {"dir": log_dir, "segment": _last_segment(log_dir, self.extension) + 1, "summary": summary}
+        self._days = {day: state}
+        return state
+
+    def _flush(self, batch: list):
+        """Write a batch of entries, opening each day's files once"""
+        days = {}
+        for now, event_type, message, fields in batch:
+            print(f"[{now.strftime('%Y-%m-%d %H:%M:%S')}] -|{event_type.upper()}|- {message}")
+            days.setdefault(now.strftime("%Y-%m-%d"), []).append((event_type, fields.get("user", ""),
+                                                                  self._format(now, event_type, message, fields)))
+
+        for day, entries in days.items():
+            state = self._open_day(day)
+            log_dir = state["dir"]
+
+            # Move a full file aside, its entries keep pointing at it through its segment number
+            path = f"{log_dir}/log.{self.extension}"
+            if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+                os.rename(path, f"{log_dir}/log.{state['segment']}.{self.extension}")
+                state["segment"] += 1
+
+            # Write the entries, noting where each one starts for the index
+            index = []
+            summary = state["summary"]
+            with open(path, "ab") as f:
+                offset = f.tell()
+                data = []
+                for event_type, user, line in entries:
+                    encoded = line.encode()
+                    data.append(encoded)
+                    user = re.sub(r"\s", " ", str(user))
+                    index.append(f"{state['segment']}\t{offset}\t{len(encoded)}\t{event_type.lower()}\t{user}\n")
+                    offset += len(encoded)
+
+                    summary["types"][event_type.lower()] = summary["types"].get(event_type.lower(), 0) + 1
+                    if user:
+                        summary["users"][user.lower()] = summary["users"].get(user.lower(), 0) + 1
+                f.write(b"".join(data))
+
+            with open(f"{log_dir}/index.tsv", "a") as f:
+                f.write("".join(index))
+            with open(f"{log_dir}/summary.json", "w") as f:
+                json.dump(summary, f)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            # Wait for the first entry, then take whatever else has queued up in the meantime
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None is queued by close() once everything before it has been written
+            if None in batch:
+                closing = True
+                batch = [entry for entry in batch if entry is not None]
+
+            try:
+                self._flush(batch)
+            except OSError as e:
+                print(f"Failed to write {len(batch)} log entries: {e}", file=sys.stderr)
+
+    def close(self, timeout: float = 5):
+        """Write out every buffered entry and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+
+def tail_lines(path: str, n: int, block_size: int = 8192) -> list:
+    """Read the last n lines of a file by reading blocks backwards from its end"""
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        data = b""
+
+        # One more newline than lines wanted, since the file ends with one
+        while position > 0 and data.count(b"\n") <= n:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+
+    lines = data.decode(errors="replace").splitlines(keepends=True)
+    return lines[-n:] if n > 0 else []
+
+
+def _segments(log_dir: str, extension: str) -> list:
+    """Paths of a day's log segments, newest first"""
+    paths = [f"{log_dir}/log.{extension}"]
+    for number in range(_last_segment(log_dir, extension), 0, -1):
+        paths.append(f"{log_dir}/log.{number}.{extension}")
+    return [path for path in paths if os.path.exists(path)]
+
+
+def _display(entry: str, extension: str) -> str:
+    """Turn a JSON lines entry back into the text format, text entries are shown as they are"""
+    if extension != "jsonl":
+        return entry
+    fields = json.loads(entry)
+    now = datetime.fromisoformat(fields["time"]).strftime("%Y-%m-%d %H:%M:%S")
+    return f"[{now}] -|{fields['type'].upper()}|- {fields['message']}\n"
+
+
+def _matches(fields: list, user: str, event_type: str) -> bool:
+    """Check an index entry (segment, offset, length, type, user) against the search filters"""
+    if event_type and fields[3] != event_type:
+        return False
+    if user:
+        name = fields[4].lower()
+        return name == user or name.split("#")[0] == user
+    return True
+
+
+def search_logs(location: str, n: int, user: str = "", event_type: str = "",
+                since: str = "", until: str = "", extension: str = "txt") -> list:
+    """Return up to n of the most recent log lines, oldest first, optionally only those of a user or event type
+    between two dates (YYYY-MM-DD, inclusive)"""
+    user, event_type = user.lower(), event_type.lower()
+    if not os.path.isdir(location):
+        return []
+
+    # Day directories are named by date, so they sort chronologically
+    days = sorted((day for day in os.listdir(location) if re.fullmatch(r"\d{4}-\d{2}-\d{2}", day)), reverse=True)
+    days = [day for day in days if (not since or day >= since) and (not until or day <= until)]
+
+    found = []
+    for day in days:
+        if len(found) >= n:
+            break
+        log_dir = f"{location}/{day}"
+
+        # Without filters, read the newest lines straight off the end of the day's segments
+        if not user and not event_type:
+            for path in _segments(log_dir, extension):
+                lines = tail_lines(path, n - len(found))
+                found.extend(_display(line, extension) for line in reversed(lines))
+                if len(found) >= n:
+                    break
+            continue
+
+        # Skip days the summary says have nothing to match
+        if not os.path.exists(f"{log_dir}/summary.json"):
+            continue
+        with open(f"{log_dir}/summary.json") as f:
+            summary = json.load(f)
+        if event_type and event_type not in summary["types"]:
+            continue
+        if user and not any(name == user or name.split("#")[0] == user for name in summary["users"]):
+            continue
+
+        # Otherwise find the day's matching entries in its index and seek straight to the newest of them
+        with open(f"{log_dir}/index.tsv") as f:
+            entries = [fields for fields in (line.rstrip("\n").split("\t") for line in f)
+                       if _matches(fields, user, event_type)]
+        newest_segment = _last_segment(log_dir, extension) + 1
+        files = {}
+        try:
+            for segment, offset, length, _, _ in reversed(entries[-(n - len(found)):]):
+                name = f"log.{extension}" if int(segment) == newest_segment else f"log.{segment}.{extension}"
+                if name not in files:
+                    files[name] = open(f"{log_dir}/{name}", "rb")
+                files[name].seek(int(offset))
+                found.append(_display(files[name].read(int(length)).decode(errors="replace"), extension))
+        finally:
+            for f in files.values():
+                f.close()
+
+    return list(reversed(found))
@@ -0,0 +1,570 @@
+import argparse
+import asyncio
+import dataclasses
+import itertools
+import json
+import os
+import signal
+import struct
+import sys
+import time
+import uuid
+from datetime import datetime
+from collections import Counter
+from typing import Callable, Optional, Tuple
+
+from autoscaler import Autoscaler, ScalingDecision
+from sandbox import ExecutionResult, Limits, SandboxPool, _SHARED_MEMORY_DIR, _collect_images, _release_images
+from scheduler import QueueFull, Scheduler
+
+# Every message is a 4-byte big-endian length followed by that many bytes of JSON. A connection starts with
+# {"op": "hello", "client"}, naming the bot it belongs to. After that, requests carry an id and an op, and a
+# connection may have any number of them in flight: replies come back tagged with the id of their request, in
+# whatever order they finish, preceded by {"id", "chunk"} messages while a snippet is printing.
+#
+#   {"op": "health"}                                -> {"health": {...}}
+#   {"op": "run", "source"}                         -> {"result": {...}}
+#   {"op": "open"}                                  -> {"handle"}, a dedicated worker for a session
+#   {"op": "session", "handle", "source", "limits"} -> {"result": {...}}, in the dedicated worker
+#   {"op": "inspect", "handle"}                     -> {"names", "memory"}
+#   {"op": "close", "handle"}                       -> {}
+#
+# A request that fails gets {"error", "message"} instead, error being "queue_full", "unknown_handle" for a handle
+# this executor didn't open or has since closed, or "failed". A bot's handles are closed when its last connection
+# drops.
+#
+# Images shown by a snippet stay in shared memory, results only carry the {"path", "shape"} of their files, so the
+# bot has to share /dev/shm with the executor. The bot reads and removes the files, as the pool does in-process.
+_HEADER = struct.Struct("!I")
+
+# far larger than any reply, which holds at most the snippet's output
+MAX_FRAME = 16 * 1024 * 1024
+
+DEFAULT_SOCKET = "/run/rubber_duck/executor.sock"
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    """Read one message, raising asyncio.IncompleteReadError once the other end has closed the connection"""
+    (length,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    if length > MAX_FRAME:
+        raise ValueError(f"frame of {length} bytes is larger than {MAX_FRAME}")
+    return json.loads(await reader.readexactly(length))
+
+
+def write_frame(writer: asyncio.StreamWriter, message: dict):
+    """Queue one message, in a single write so that messages written by concurrent requests never interleave"""
+    data = json.dumps(message, separators=(",", ":")).encode()
+    writer.write(_HEADER.pack(len(data)) + data)
+
+
+class UnknownHandle(Exception):
+    """Raised for a dedicated worker the executor doesn't have, because it was closed or the executor restarted"""
+
+
+def _claim_images(shown: list) -> list:
+    """Move shown images out of their worker's name, so that killing the worker can't remove them before the bot has
+    read them"""
+    claimed = []
+    for image in shown:
+        path = f"{_SHARED_MEMORY_DIR}/rubber_duck_executor_{uuid.uuid4().hex}"
+        os.rename(image["path"], path)
+        claimed.append(dict(image, path=path))
+    return claimed
+
+
+def decode_result(data: dict) -> ExecutionResult:
+    """Turn a result back into an ExecutionResult, reading its images out of shared memory"""
+    return ExecutionResult(**dict(data, images=_collect_images(data["images"])))
+
+
+class ExecutorServer:
+    """Serves a pool of sandbox workers on a Unix socket, so that several bots share one warm fleet"""
+
+    def __init__(self, pool: SandboxPool, scheduler: Scheduler, handle_timeout: float = 3600,
+                 on_result: Optional[Callable[[ExecutionResult], None]] = None):
+        self.pool = pool
+        self.scheduler = scheduler
+        self.on_result = on_result
+        # dedicated workers nobody has used for this long are killed, in case their bot forgot to close them
+        self.handle_timeout = handle_timeout
+        self.started = time.time()
+        self.connections = 0
+
+        # handle -> [dedicated worker, bot that opened it, time it was last used]
+        self._handles = {}
+        # bot -> its open connections
+        self._bots = Counter()
+        self._writers = set()
+        self._clients = itertools.count(1)
+        self._task = None
+
+    def health(self) -> dict:
+        return {
+            "workers": self.pool.size, "busy": self.pool.busy, "queued": self.scheduler.queued,
+            "runs": self.pool.runs, "kills": self.pool.kills, "compile_cache": self.pool.compile_cache_stats,
+            "limits": dataclasses.asdict(self.pool.limits), "timeout": self.pool.timeout,
+            "sessions": len(self._handles), "connections": self.connections, "bots": len(self._bots),
+            "uptime": time.time() - self.started,
+        }
+
+    def _dedicated(self, handle: str):
+        """The dedicated worker of a handle this executor opened"""
+        if handle not in self._handles:
+            raise UnknownHandle(f"no dedicated worker {handle}")
+        entry = self._handles[handle]
+        entry[2] = time.monotonic()
+        return entry[0]
+
+    def _close(self, handle: str):
+        entry = self._handles.pop(handle, None)
+        if entry is not None:
+            entry[0].kill()
+
+    def _result(self, result: ExecutionResult) -> dict:
+        return {"result": dict(dataclasses.asdict(result), images=_claim_images(result.images))}
+
+    async def _dispatch(self, bot: str, message: dict, on_output: Callable[[str], None]) -> dict:
+        op = message.get("op")
+        if op == "health":
+            return {"health": self.health()}
+        if op == "run":
+            # Each bot counts as a channel of its own, so a busy one can't starve the others
+            result = await self.scheduler.submit(message["source"], user=bot, channel=bot, on_output=on_output)
+            if self.on_result is not None:
+                self.on_result(result)
+            return self._result(result)
+        if op == "open":
+            handle = uuid.uuid4().hex
+            self._handles[handle] = [self.pool.spawn_dedicated(), bot, time.monotonic()]
+            return {"handle": handle}
+        if op == "session":
+            worker = self._dedicated(message["handle"])
+            result = await self.pool.run_dedicated(worker, message["source"], Limits(**message["limits"]),
+                                                   on_output=on_output)
+            if result.killed:
+                self._close(message["handle"])
+            return self._result(result)
+        if op == "inspect":
+            worker = self._dedicated(message["handle"])
+            try:
+                names, memory = await self.pool.inspect_dedicated(worker)
+            except RuntimeError:
+                self._close(message["handle"])
+                raise
+            return {"names": names, "memory": memory}
+        if op == "close":
+            self._close(message["handle"])
+            return {}
+        raise ValueError(f"unknown op {op!r}")
+
+    async def _handle(self, bot: str, message: dict, writer: asyncio.StreamWriter):
+        """Answer one request, streaming the snippet's output back as it is printed"""
+        request_id = message.get("id")
+
+        def on_output(chunk: str):
+            if not writer.is_closing():
+                write_frame(writer, {"id": request_id, "chunk": chunk})
+
+        try:
+            reply = await self._dispatch(bot, message, on_output)
+        except QueueFull as e:
+            reply = {"error": "queue_full", "message": str(e)}
+        except UnknownHandle as e:
+            reply = {"error": "unknown_handle", "message": str(e)}
+        except Exception as e:
+            reply = {"error": "failed", "message": f"{type(e).__name__}: {e}"}
+        if writer.is_closing():
+            # Nobody is left to read the images
+            _release_images(reply.get("result", {}).get("images", []))
+            return
+        write_frame(writer, dict(reply, id=request_id))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Read requests off a connection and answer each in its own task, so they are pipelined"""
+        bot = None
+        self.connections += 1
+        self._writers.add(writer)
+        tasks = set()
+        try:
+            hello = await read_frame(reader)
+            if hello.get("op") != "hello":
+                return
+            bot = str(hello.get("client") or f"connection {next(self._clients)}")
+            self._bots[bot] += 1
+            while True:
+                message = await read_frame(reader)
+                task = asyncio.ensure_future(self._handle(bot, message, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            # Snippets already running finish and free their workers, their replies have nowhere to go
+            self.connections -= 1
+            self._writers.discard(writer)
+            writer.close()
+
+            # A bot that is gone for good, or restarted under a new name, has lost its sessions
+            if bot is not None:
+                self._bots[bot] -= 1
+                if not self._bots[bot]:
+                    del self._bots[bot]
+                    for handle, (_, owner, _) in list(self._handles.items()):
+                        if owner == bot:
+                            self._close(handle)
+
+    def expire(self):
+        """Kill the dedicated workers that have not been used for longer than the handle timeout"""
+        deadline = time.monotonic() - self.handle_timeout
+        for handle, (_, _, last_used) in list(self._handles.items()):
+            if last_used < deadline:
+                self._close(handle)
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(min(self.handle_timeout / 4, 60))
+            self.expire()
+
+    async def serve(self, path: str) -> asyncio.AbstractServer:
+        """Start listening on the socket, replacing a stale one left behind by an executor that has exited"""
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        server = await asyncio.start_unix_server(self._serve, path)
+        os.chmod(path, 0o660)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._expire())
+        return server
+
+    def close(self):
+        """Kill the dedicated workers and hang up on every bot"""
+        for handle in list(self._handles):
+            self._close(handle)
+        for writer in list(self._writers):
+            writer.close()
+
+
+class _Connection:
+    """One connection to the executor, with every request sent over it waiting for its reply by id"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        # request id -> (future of the reply, callback for output chunks)
+        self.pending = {}
+        self._task = asyncio.ensure_future(self._read())
+
+    @property
+    def closed(self) -> bool:
+        return self._task.done()
+
+    async def _read(self):
+        try:
+            while True:
+                message = await read_frame(self.reader)
+                entry = self.pending.get(message["id"])
+                if entry is None:
+                    # The request was given up on, and its images with it
+                    _release_images(message.get("result", {}).get("images", []))
+                    continue
+                future, on_output = entry
+                if "chunk" in message:
+                    if on_output is not None:
+                        on_output(message["chunk"])
+                    continue
+                del self.pending[message["id"]]
+                if not future.done():
+                    future.set_result(message)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.writer.close()
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("lost the connection to the executor"))
+            self.pending.clear()
+
+    async def request(self, message: dict, on_output: Optional[Callable[[str], None]] = None) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message["id"]] = (future, on_output)
+        try:
+            write_frame(self.writer, message)
+            await self.writer.drain()
+            return await future
+        finally:
+            self.pending.pop(message["id"], None)
+
+    def close(self):
+        self._task.cancel()
+
+
+class _RemoteWorker:
+    """A dedicated worker on the executor, opened on its first use"""
+
+    def __init__(self, client: "ExecutorClient"):
+        self.client = client
+        self.handle = None
+        self.alive = True
+
+    def kill(self):
+        """Have the executor kill the worker, doing nothing if it is already dead"""
+        if not self.alive:
+            return
+        self.alive = False
+        if self.handle is None:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Shutting down, the executor closes the worker along with our connections
+            return
+        asyncio.ensure_future(self.client.close_dedicated(self.handle))
+
+
+class ExecutorClient:
+    """Runs snippets on an executor daemon over a few pipelined connections, standing in for a SandboxPool"""
+
+    def __init__(self, path: str, connections: int = 2, size: int = 1, timeout: float = 10,
+                 limits: Limits = Limits(), health_interval: float = 5):
+        self.path = path
+        self.health_interval = health_interval
+        self._connections = [None] * connections
+        self._connecting = [asyncio.Lock() for _ in range(connections)]
+        self._ids = itertools.count()
+        self._task = None
+        # tells the executor which connections belong to the same bot, which it shares the workers out by and closes
+        # the sessions of once they are all gone
+        self.name = uuid.uuid4().hex
+
+        # the executor's state as of its last health check, until then what it is expected to be configured with
+        self.size = size
+        self.timeout = timeout
+        self.limits = limits
+        self.busy = 0
+        self.queued = 0
+        self.runs = 0
+        self.kills = 0
+        self.compile_cache_stats = (0, 0)
+        self.healthy = False
+        self.last_health = None
+        # the workers are the executor's processes, not ours to sample
+        self.worker_pids = ()
+
+    async def _open(self, slot: int) -> _Connection:
+        async with self._connecting[slot]:
+            connection = self._connections[slot]
+            if connection is None or connection.closed:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                write_frame(writer, {"op": "hello", "client": self.name})
+                connection = self._connections[slot] = _Connection(reader, writer)
+            return connection
+
+    async def _connection(self) -> _Connection:
+        """The open connection with the fewest requests in flight, opening one if there is none"""
+        open_slots = [slot for slot, connection in enumerate(self._connections)
+                      if connection is not None and not connection.closed]
+        if open_slots:
+            slot = min(open_slots, key=lambda slot: len(self._connections[slot].pending))
+            # Spread out over a connection that isn't open yet rather than pile onto a busy one
+            if self._connections[slot].pending and len(open_slots) < len(self._connections):
+                slot = next(slot for slot, connection in enumerate(self._connections)
+                            if connection is None or connection.closed)
+        else:
+            slot = 0
+        return await self._open(slot)
+
+    async def _request(self, op: str, on_output: Optional[Callable[[str], None]] = None, **fields) -> dict:
+        connection = await self._connection()
+        reply = await connection.request(dict(fields, id=next(self._ids), op=op), on_output)
+        if reply.get("error") == "queue_full":
+            raise QueueFull(reply["message"])
+        if reply.get("error") == "unknown_handle":
+            raise UnknownHandle(reply["message"])
+        if "error" in reply:
+            raise RuntimeError(reply["message"])
+        return reply
+
+    async def check_health(self) -> bool:
+        """Ask the executor how it is doing, updating the state mirrored from it"""
+        try:
+            health = (await asyncio.wait_for(self._request("health"), self.health_interval))["health"]
+        except (OSError, asyncio.TimeoutError, RuntimeError):
+            # A connection that doesn't answer in time is as good as dead
+            if self.healthy:
+                for connection in self._connections:
+                    if connection is not None:
+                        connection.close()
+            self.healthy = False
+            return False
+
+        self.size = health["workers"]
+        self.busy = health["busy"]
+        self.queued = health["queued"]
+        self.runs = health["runs"]
+        self.kills = health["kills"]
+        self.compile_cache_stats = tuple(health["compile_cache"])
+        self.limits = Limits(**health["limits"])
+        self.timeout = health["timeout"]
+        self.healthy = True
+        self.last_health = health
+        return True
+
+    async def _run_health_checks(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        """Start checking the executor's health in the background, doing nothing if it is already running"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run_health_checks())
+
+    async def _run(self, op: str, on_output: Optional[Callable[[str], None]], **fields) -> ExecutionResult:
+        try:
+            reply = await self._request(op, on_output, **fields)
+        except UnknownHandle:
+            return ExecutionResult(error="the session's worker is gone, the executor has restarted", killed=True)
+        except (OSError, RuntimeError) as e:
+            # Not cached, and a session can't trust the worker's state any more
+            self.healthy = False
+            return ExecutionResult(error=f"the executor is unavailable ({e})", killed=True)
+        try:
+            # Reading the images copies up to 64MB, which is left to a thread as it is on the way out to Discord
+            return await asyncio.to_thread(decode_result, reply["result"])
+        except OSError as e:
+            # The bot doesn't share /dev/shm with the executor
+            _release_images(reply["result"]["images"])
+            return ExecutionResult(**dict(reply["result"], images=[],
+                                          error=f"the images could not be read from shared memory ({e})"))
+
+    async def run(self, source: str, timeout: Optional[float] = None,
+                  on_output: Optional[Callable[[str], None]] = None) -> ExecutionResult:
+        """Run the given code on the executor's pool, calling on_output with text as it is printed"""
+        return await self._run("run", on_output, source=source)
+
+    def spawn_dedicated(self) -> _RemoteWorker:
+        return _RemoteWorker(self)
+
+    async def _open_dedicated(self, worker: _RemoteWorker) -> bool:
+        """Open the worker on the executor if it isn't yet, returning whether it is alive"""
+        if worker.handle is None and worker.alive:
+            try:
+                worker.handle = (await self._request("open"))["handle"]
+            except (OSError, RuntimeError):
+                worker.alive = False
+                return False
+
+            # Killed while it was being opened
+            if not worker.alive:
+                await self.close_dedicated(worker.handle)
+        return worker.alive
+
+    async def run_dedicated(self, worker: _RemoteWorker, source: str, limits: Limits,
+                            timeout: Optional[float] = None,
+                            on_output: Optional[Callable[[str], None]] = None) -> ExecutionResult:
+        if not await self._open_dedicated(worker):
+            return ExecutionResult(error="the executor is unavailable", killed=True)
+        result = await self._run("session", on_output, handle=worker.handle, source=source,
+                                 limits=dataclasses.asdict(limits))
+        if result.killed:
+            worker.alive = False
+        return result
+
+    async def inspect_dedicated(self, worker: _RemoteWorker, timeout: Optional[float] = None) -> Tuple[list, int]:
+        if not await self._open_dedicated(worker):
+            raise RuntimeError("the executor is unavailable")
+        try:
+            reply = await self._request("inspect", handle=worker.handle)
+        except (OSError, RuntimeError, UnknownHandle) as e:
+            worker.alive = False
+            raise RuntimeError(f"the session could not be inspected ({e})")
+        return [tuple(name) for name in reply["names"]], reply["memory"]
+
+    async def close_dedicated(self, handle: str):
+        try:
+            await self._request("close", handle=handle)
+        except (OSError, RuntimeError):
+            # The executor kills it when the handle expires
+            pass
+
+    def close(self):
+        """Close the connections, leaving the executor and its workers running"""
+        if self._task is not None:
+            self._task.cancel()
+        for connection in self._connections:
+            if connection is not None:
+                connection.close()
+
+
+def log(message: str):
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {message}", flush=True)
+
+
+async def check(path: str) -> bool:
+    """Whether an executor answers on the socket, for container health checks"""
+    client = ExecutorClient(path, connections=1)
+    try:
+        return await client.check_health()
+    finally:
+        client.close()
+
+
+async def serve(path: str, min_workers: int, max_workers: int):
+    # Create the same pool the bot would run on its own, leaving shown images in shared memory for the bot to read
+    pool = SandboxPool(size=min_workers, timeout=10, warm=True,
+                       limits=Limits(memory=100 * 1024 * 1024, cpu=5, output=64 * 1024), collect_images=False)
+    scheduler = Scheduler(pool, backlog=200)
+
+    def log_scaling(decision: ScalingDecision):
+        log(f"sandbox pool resized from {decision.old_size} to {decision.new_size} workers ({decision.reason})")
+
+    # The executor holds the workers, so it is the one that sees the memory they take up
+    autoscaler = Autoscaler(scheduler, min_size=min_workers, max_size=max_workers, interval=5,
+                            on_decision=log_scaling)
+
+    # Queue waits are what the autoscaler grows the pool on
+    def observe(result: ExecutionResult):
+        autoscaler.observe(result.timings["queue_wait"])
+
+    executor = ExecutorServer(pool, scheduler, on_result=observe)
+
+    server = await executor.serve(path)
+    autoscaler.start()
+    log(f"executor listening on {path} with {pool.size} workers")
+
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        server.close()
+        autoscaler.stop()
+        executor.close()
+        # Let the connections see they were closed before the loop goes away
+        await asyncio.sleep(0.1)
+        pool.close()
+        os.remove(path)
+        log("executor stopped")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Run the sandbox workers as a daemon that bots connect to over a "
+                                                 "Unix socket, keeping them warm across bot restarts")
+    parser.add_argument("--socket", default=os.getenv("EXECUTOR_SOCKET", DEFAULT_SOCKET))
+    parser.add_argument("--min-workers", type=int, default=int(os.getenv("POOL_MIN_WORKERS", "2")))
+    parser.add_argument("--max-workers", type=int, default=int(os.getenv("POOL_MAX_WORKERS", "8")))
+    parser.add_argument("--check", action="store_true", help="exit 0 if an executor answers on the socket, 1 if not")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if asyncio.run(check(args.socket)) else 1)
+    asyncio.run(serve(args.socket, args.min_workers, args.max_workers))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,208 @@
+import ast
+import asyncio
+import io
+import math
+import operator
+import time
+from typing import Optional
+
+from sandbox import ExecutionResult, Limits
+
+# largest integer the evaluator will produce, printing it stays well inside Python's digit limit
+MAX_INT_BITS = 8192
+
+# largest string or sequence the evaluator will produce
+MAX_LENGTH = 4096
+
+# most characters a list or tuple may print as, its elements together
+MAX_SIZE = 64 * 1024
+
+_BIN_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow, ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift, ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor,
+}
+_UNARY_OPS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_, ast.Invert: operator.invert}
+_COMPARE_OPS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt,
+    ast.GtE: operator.ge, ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+
+# f-string conversions, none (-1), !s, !r and !a
+_CONVERSIONS = {-1: str, ord("s"): str, ord("r"): repr, ord("a"): ascii}
+
+# types a literal may have, anything else is left to the sandbox
+_LITERAL_TYPES = (int, float, str, bool, type(None))
+
+
+class _NotTrivial(Exception):
+    """Raised when a snippet steps outside what the fast path can prove bounded"""
+
+
+def _size(value) -> int:
+    """Roughly how many characters a literal prints as"""
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, int):
+        return value.bit_length() * 30103 // 100000 + 2
+    return 24
+
+
+def _check(value):
+    """Make sure a value stays within the bounds"""
+    if isinstance(value, int) and value.bit_length() > MAX_INT_BITS:
+        raise _NotTrivial("integer too large")
+    if isinstance(value, (str, list, tuple)) and len(value) > MAX_LENGTH:
+        raise _NotTrivial("sequence too long")
+
+    # Repeating a sequence only copies references, so count what its elements print as too. Sequences of
+    # sequences are left to the sandbox, their size multiplies with every level of nesting
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(element, (list, tuple)) for element in value):
+            raise _NotTrivial("nested sequence")
+        if sum(_size(element) + 2 for element in value) > MAX_SIZE:
+            raise _NotTrivial("sequence too large")
+    return value
+
+
+def _binary(op: ast.operator, left, right):
+    """Apply a binary operator, refusing any whose result could blow past the bounds before it is checked"""
+    if type(op) not in _BIN_OPS:
+        raise _NotTrivial("unsupported operator")
+
+    # Estimate sizes before computing, as computing is what would take the time
+    if isinstance(op, ast.Pow) and isinstance(left, int) and isinstance(right, int) and right > 0:
+        if right * math.log2(max(abs(left), 2)) > MAX_INT_BITS:
+            raise _NotTrivial("exponent too large")
+    elif isinstance(op, ast.LShift) and isinstance(right, int) and right > MAX_INT_BITS:
+        raise _NotTrivial("shift too large")
+    elif isinstance(op, ast.Mult):
+        if isinstance(left, (str, list, tuple)) or isinstance(right, (str, list, tuple)):
+            sequence, count = (left, right) if isinstance(left, (str, list, tuple)) else (right, left)
+            if isinstance(count, int) and len(sequence) * count > MAX_LENGTH:
+                raise _NotTrivial("sequence too long")
+    elif isinstance(op, ast.Mod) and isinstance(left, str):
+        # printf-style formatting can pad to any width
+        raise _NotTrivial("string formatting")
+    return _check(_BIN_OPS[type(op)](left, right))
+
+
+def _evaluate(node: ast.AST, names: dict):
+    """Evaluate an expression made of literals, names bound earlier in the snippet and operators"""
+    if isinstance(node, ast.Constant):
+        if not isinstance(node.value, _LITERAL_TYPES):
+            raise _NotTrivial("unsupported literal")
+        return _check(node.value)
+    if isinstance(node, ast.Name):
+        if node.id not in names:
+            raise _NotTrivial(f"unknown name {node.id}")
+        return names[node.id]
+    if isinstance(node, ast.UnaryOp):
+        return _UNARY_OPS[type(node.op)](_evaluate(node.operand, names))
+    if isinstance(node, ast.BinOp):
+        return _binary(node.op, _evaluate(node.left, names), _evaluate(node.right, names))
+    if isinstance(node, ast.BoolOp):
+        value = None
+        for operand in node.values:
+            value = _evaluate(operand, names)
+            if isinstance(node.op, ast.And) != bool(value):
+                break
+        return value
+    if isinstance(node, ast.Compare):
+        left = _evaluate(node.left, names)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _evaluate(comparator, names)
+            if type(op) not in _COMPARE_OPS:
+                raise _NotTrivial("unsupported comparison")
+            if not _COMPARE_OPS[type(op)](left, right):
+                return False
+            left = right
+        return True
+    if isinstance(node, ast.IfExp):
+        return _evaluate(node.body if _evaluate(node.test, names) else node.orelse, names)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [_evaluate(element, names) for element in node.elts]
+        return _check(values if isinstance(node, ast.List) else tuple(values))
+    if isinstance(node, ast.JoinedStr):
+        return _check("".join(_evaluate(part, names) for part in node.values))
+    if isinstance(node, ast.FormattedValue):
+        # A format spec can pad to any width, so only plain conversions are allowed
+        if node.format_spec is not None:
+            raise _NotTrivial("format spec")
+        if node.conversion not in _CONVERSIONS:
+            raise _NotTrivial("unsupported conversion")
+        return _check(_CONVERSIONS[node.conversion](_evaluate(node.value, names)))
+    raise _NotTrivial(f"unsupported expression {type(node).__name__}")
+
+
+def _is_print(statement: ast.stmt) -> bool:
+    return (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call)
+            and isinstance(statement.value.func, ast.Name) and statement.value.func.id == "print")
+
+
+def classify(source: str) -> Optional[ast.Module]:
+    """Return the parsed snippet if it only assigns names and prints, with no loops, imports or other calls"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+
+    for statement in tree.body:
+        if _is_print(statement):
+            call = statement.value
+            if any(isinstance(arg, ast.Starred) for arg in call.args) \
+                    or any(keyword.arg not in ("sep", "end") for keyword in call.keywords):
+                return None
+        elif isinstance(statement, ast.Assign):
+            # The sandbox refuses names starting with an underscore, and gives print and printed a meaning
+            if not all(isinstance(target, ast.Name) and not target.id.startswith("_")
+                       and target.id not in ("print", "printed") for target in statement.targets):
+                return None
+        elif not isinstance(statement, ast.Expr):
+            return None
+
+        # No calls besides the print itself
+        calls = [node for node in ast.walk(statement) if isinstance(node, (ast.Call, ast.Lambda))]
+        if calls != ([statement.value] if _is_print(statement) else []):
+            return None
+    return tree
+
+
+def evaluate(tree: ast.Module, output_limit: int = Limits.output) -> Optional[str]:
+    """Run a classified snippet and return what it printed, or None if it has to go to the sandbox after all"""
+    names = {}
+    printed = io.StringIO()
+    try:
+        for statement in tree.body:
+            if isinstance(statement, ast.Assign):
+                value = _evaluate(statement.value, names)
+                for target in statement.targets:
+                    names[target.id] = value
+            elif _is_print(statement):
+                call = statement.value
+                args = [_evaluate(arg, names) for arg in call.args]
+                kwargs = {keyword.arg: _evaluate(keyword.value, names) for keyword in call.keywords}
+                print(*args, **kwargs, file=printed)
+            else:
+                _evaluate(statement.value, names)
+
+            # Output that needs truncating is handled by the sandbox, so both paths cut it the same way
+            if len(printed.getvalue().encode()) > output_limit:
+                return None
+    except Exception:
+        # Errors are left to the sandbox too, so their messages match whatever path the snippet takes
+        return None
+    return printed.getvalue()
+
+
+async def run_trivial(source: str, output_limit: int = Limits.output) -> Optional[ExecutionResult]:
+    """Evaluate the snippet on a thread if it is provably bounded, or return None so it goes to the sandbox"""
+    tree = classify(source)
+    if tree is None:
+        return None
+
+    start = time.perf_counter()
+    output = await asyncio.to_thread(evaluate, tree, output_limit)
+    if output is None:
+        return None
+    return ExecutionResult(output=output, timings={"execute": time.perf_counter() - start})
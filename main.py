@@ -1,24 +1,31 @@
+import asyncio
 import subprocess
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 import humanize
+import io
 import os
 import functools
 import re
-import ast
 import platform
-import psutil
 import re
-from typing import Tuple
-
-import multiprocess
-from pathos.multiprocessing import ProcessPool
 
 import dotenv
 import discord
 from discord.ext import bridge
-import RestrictedPython
-from RestrictedPython import compile_restricted, limited_builtins, safe_builtins, utility_builtins
-from RestrictedPython.PrintCollector import PrintCollector
+
+from attachments import FIELD_LIMIT, render
+from autoscaler import Autoscaler, ScalingDecision
+from event_log import LogWriter, search_logs
+from executor import ExecutorClient
+from fast_path import run_trivial
+from metrics import Histogram, MetricsRegistry
+from preflight import Preflight
+from result_cache import ResultCache
+from sandbox import Limits, SandboxPool
+from scheduler import QueueFull, Scheduler
+from sessions import SessionManager, SessionsFull
+from system_sampler import SystemSampler, sparkline
+from throttle import ThrottledUpdate
 
 # Load environment variables from a .env file
 dotenv.load_dotenv()
@@ -26,19 +33,11 @@ dotenv.load_dotenv()
 # Record the time at which the script was started
 load_start_delta = datetime.now()
 
-# list of supported modules (refer to requirements.txt)
-_SAFE_MODULES = frozenset(("math", "numpy", "requests",
-                          "pillow", "asyncio", "pygame", "scipy", "pandas"))
-
 # location of logging
 LOG_LOCATION = '/root/rubber_duck/logs'
 
-
-# function for calling __import__ in the safe environment
-def _safe_import(name, *args, **kwargs):
-    if name not in _SAFE_MODULES:
-        raise Exception(f"{name} is not a supported module.")
-    return __import__(name, *args, **kwargs)
+# Write logs from a background thread, as plain text or as JSON lines (LOG_FORMAT=jsonl) with typed fields
+log_writer = LogWriter(LOG_LOCATION, fmt=os.getenv("LOG_FORMAT", "text"))
 
 
 def get_uptime() -> str:
@@ -50,55 +49,27 @@ def get_uptime() -> str:
     return f"{str(d['%H']) + 'h ' if d['%H'] > 0 else ''}{str(d['%M']) + 'm ' if d['%M'] > 0 else ''}{str(d['%S']) + 's' if d['%S'] > 0 else ''}"
 
 
-def interpret(code: str) -> Tuple[str, str]:
-    """Interpret the given code in a safe execution environment and return the results"""
-    # Append the code to collect the printed output
-    code += "\nresults = printed"
-
-    # Compile the code using RestrictedPython
-    byte_code = compile_restricted(
-        code,
-        filename="<string>",
-        mode="exec",
-    )
-
-    # Create a safe execution environment
-    data = {
-        "_print_": PrintCollector,
-        "__builtins__": {
-            **limited_builtins,
-            **safe_builtins,
-            **utility_builtins,
-            "all": all,
-            "any": any,
-            "_getiter_": RestrictedPython.Eval.default_guarded_getiter,
-            "_iter_unpack_sequence_": RestrictedPython.Guards.guarded_iter_unpack_sequence,
-            "__import__": _safe_import
-        },
-        "_getattr_": RestrictedPython.Guards.safer_getattr
-    }
-
-    # Execute the code in the safe environment
-    exec(byte_code, data, None)
-
-    # Return the printed output
-    return data["results"]
-
-
 def get_git_info() -> str:
     """Get the latest git commit hash and branch and return them as a string"""
-    # Get the latest commit hash
-    last_commit = subprocess.check_output(
-        ["git", "rev-parse", "HEAD"], text=True)[:8]
+    try:
+        # Get the latest commit hash
+        last_commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL)[:8]
 
-    # Get the current branch
-    current_branch = subprocess.check_output(
-        ["git", "rev-parse", "--abbrev-ref", "HEAD"], text=True)
+        # Get the current branch
+        current_branch = subprocess.check_output(
+            ["git", "rev-parse", "--abbrev-ref", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return "unknown"
 
     # Return the commit hash and branch as a string
     return f"{last_commit} @ {current_branch}"
 
 
+# The checkout doesn't change while the bot runs, so look it up once
+git_info = get_git_info()
+
+
 def abbreviate_time_units(delta: str) -> str:
     """Replace full time unit names with their abbreviations."""
     abbreviations = {
@@ -116,22 +87,9 @@ def abbreviate_time_units(delta: str) -> str:
     return delta
 
 
-def log_event(message: str, event_type: str):
-    """Log an event to a file"""
-    # Get the current date and time
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # Create a log message with the current date, time, and the provided message
-    log_message = f"[{now}] -|{event_type.upper()}|- {message}\n"
-    print(log_message.strip())
-
-     # Construct the directory path and ensure it exists
-    log_dir = f"{LOG_LOCATION}/{datetime.now().strftime('%Y-%m-%d')}"
-    os.makedirs(log_dir, exist_ok=True)  # Safely create the directory if it doesn't exist
-
-    # Open the log file in append mode and write the log message
-    with open(f"{log_dir}/log.txt", "a+") as f:
-        f.write(log_message)
+def log_event(message: str, event_type: str, **fields):
+    """Log an event, the file is written in the background by the log writer"""
+    log_writer.write(event_type, message, **fields)
 
 
 def logging(func):
@@ -148,7 +106,9 @@ def logging(func):
             # Abbreviate the time units in the elapsed time string
             elapsed_time = abbreviate_time_units(elapsed_time)
             log_event(
-                f"{func.__name__} called by {ctx.author} in #{ctx.channel} (took {elapsed_time})", "command")
+                f"{func.__name__} called by {ctx.author} in #{ctx.channel} (took {elapsed_time})", "command",
+                command=func.__name__, user=str(ctx.author), channel=str(ctx.channel),
+                duration_ms=round((end_time - start_time).total_seconds() * 1000, 3))
         return result
     return wrapper
 
@@ -163,8 +123,104 @@ bot = bridge.Bot(command_prefix="<@1047186063606698016> ",
 # Load the ID of the message to be edited when the bot is restarted from the environment variables
 reboot_id = os.getenv("REBOOT_ID")
 
-# Create a process pool with 4 nodes
-pool = ProcessPool(nodes=4)
+# bounds of the sandbox pool's size, which the autoscaler moves between
+POOL_MIN_WORKERS = int(os.getenv("POOL_MIN_WORKERS", "2"))
+POOL_MAX_WORKERS = int(os.getenv("POOL_MAX_WORKERS", "8"))
+
+# Run snippets on the executor daemon listening on EXECUTOR_SOCKET if there is one, so several bots share its warm
+# workers and restarting the bot doesn't cold-start them, otherwise on a pool of our own
+EXECUTOR_SOCKET = os.getenv("EXECUTOR_SOCKET")
+
+# Create a supervised pool of pre-warmed sandbox workers, each snippet gets 10 seconds,
+# 5 seconds of CPU time, 100MB of memory and 64KB of output
+if EXECUTOR_SOCKET:
+    pool = ExecutorClient(EXECUTOR_SOCKET, connections=2, size=POOL_MIN_WORKERS, timeout=10,
+                          limits=Limits(memory=100 * 1024 * 1024, cpu=5, output=64 * 1024))
+else:
+    pool = SandboxPool(size=POOL_MIN_WORKERS, timeout=10, warm=True,
+                       limits=Limits(memory=100 * 1024 * 1024, cpu=5, output=64 * 1024))
+
+# Share the workers fairly between channels and users, turning snippets away once 50 are waiting
+scheduler = Scheduler(pool, backlog=50)
+
+
+def log_scaling(decision: ScalingDecision):
+    """Log a change of the pool's size"""
+    pool_resizes["grow" if decision.new_size > decision.old_size else "shrink"].inc()
+    log_event(f"sandbox pool resized from {decision.old_size} to {decision.new_size} workers ({decision.reason})",
+              "scaling", old_size=decision.old_size, new_size=decision.new_size, reason=decision.reason)
+
+
+# Grow the pool while snippets queue up and the container has memory to spare, and shrink it again when idle
+autoscaler = Autoscaler(scheduler, min_size=POOL_MIN_WORKERS, max_size=POOL_MAX_WORKERS, interval=5,
+                        on_decision=log_scaling)
+
+# Reuse the output of deterministic snippets for 10 minutes, and share one run between identical ones
+results = ResultCache(size=512, ttl=600)
+
+# Turn away snippets that are bound to fail before they take up a worker, remembering the last 1024 verdicts
+preflight = Preflight(pool.limits, size=1024)
+
+
+def log_session_end(user: int, reason: str):
+    """Log the end of a REPL session"""
+    log_event(f"session of user {user} ended ({reason})", "session", user=str(user), reason=reason)
+
+
+# Keep up to SESSION_CAPACITY opt-in REPL sessions, each in its own worker with 100MB for all its snippets together,
+# ending them after 15 idle minutes
+sessions = SessionManager(pool, capacity=int(os.getenv("SESSION_CAPACITY", "2")), idle_timeout=15 * 60,
+                          memory=100 * 1024 * 1024, on_end=log_session_end)
+
+# Evaluate snippets that only print literal arithmetic and strings in the bot itself, set FAST_PATH=0 to send
+# every snippet to the sandbox
+fast_path_enabled = os.getenv("FAST_PATH", "1") != "0"
+
+# Record how long each phase of running a snippet takes and what came of it,
+# served to a local Prometheus on METRICS_PORT and summarised in the stats command
+metrics = MetricsRegistry()
+metrics_server = None
+phase_seconds = {
+    phase: metrics.histogram("phase_seconds", "Seconds spent in each phase of running a snippet", phase=phase)
+    for phase in ("queue_wait", "compile", "execute", "transfer", "edit", "total")
+}
+snippet_outcomes = {
+    outcome: metrics.counter("snippets_total", "Snippets handled, by outcome", outcome=outcome)
+    for outcome in ("ok", "error", "timeout", "cpu_limit", "memory_limit", "rejected", "preflight")
+}
+fast_path_runs = metrics.counter("fast_path_total", "Trivial snippets evaluated without a sandbox worker")
+preflight_saved_seconds = metrics.counter("preflight_saved_seconds_total",
+                                          "Estimated worker time saved by rejecting snippets before they ran")
+metrics.counter("worker_kills_total", "Sandbox workers killed and replaced", read=lambda: pool.kills)
+metrics.counter("compile_cache_hits_total", "Snippets whose compiled code was reused",
+                read=lambda: pool.compile_cache_stats[0])
+metrics.counter("compile_cache_misses_total", "Snippets that had to be compiled",
+                read=lambda: pool.compile_cache_stats[1])
+metrics.counter("result_cache_hits_total", "Snippets answered from the result cache or a shared run",
+                read=lambda: results.hits + results.coalesced)
+metrics.gauge("pool_workers", "Sandbox workers in the pool", read=lambda: pool.size)
+metrics.gauge("pool_busy_workers", "Sandbox workers running a snippet", read=lambda: pool.busy)
+metrics.gauge("queue_depth", "Snippets waiting for a sandbox worker", read=lambda: scheduler.queued)
+if EXECUTOR_SOCKET:
+    metrics.gauge("executor_up", "Whether the executor answered its last health check", read=lambda: int(pool.healthy))
+metrics.gauge("memory_headroom_bytes", "Memory the autoscaler can still hand to new workers",
+              read=lambda: autoscaler.headroom)
+pool_resizes = {
+    direction: metrics.counter("pool_resizes_total", "Changes of the sandbox pool's size", direction=direction)
+    for direction in ("grow", "shrink")
+}
+
+# Sample the host and the sandbox workers every 5 seconds, keeping the last hour for the stats command
+sampler = SystemSampler(pool, interval=5, history=720)
+
+
+def format_quantiles(histogram: Histogram) -> str:
+    """Format the p50/p95/p99 estimates of a histogram of seconds"""
+    if not histogram.count:
+        return "no data yet"
+    return " / ".join(
+        f"{value * 1000:.0f}ms" if value < 1 else f"{value:.2f}s"
+        for value in (histogram.quantile(q) for q in (0.5, 0.95, 0.99)))
 
 
 # Event handler for when the bot is ready
@@ -192,6 +248,19 @@ async def on_ready():
     await bot.change_presence(
         activity=discord.Activity(type=discord.ActivityType.listening, name="your python | [>>]"))
 
+    # Start sampling the system, and serving the metrics, on_ready runs again after every reconnect
+    sampler.start()
+    if EXECUTOR_SOCKET:
+        # The executor scales its own pool, we only keep track of its size and health
+        await pool.check_health()
+        pool.start()
+    else:
+        autoscaler.start()
+    sessions.start_expiry()
+    global metrics_server
+    if metrics_server is None:
+        metrics_server = await metrics.serve(int(os.getenv("METRICS_PORT", "9464")))
+
     # Log a startup message to the console
     log_event(f"logged in as {bot.user}", "startup")
 
@@ -231,17 +300,106 @@ async def on_message(message):
         embedded.set_footer(
             text=f"Rubber Duck - Input from {message.author} ・ {date.today()}")
 
-        # Execute the code in a separate process
-        result = pool.apipe(interpret, source)
-        output = None
-
-        # Try to get the output of the code execution, with a timeout of 10 seconds
-        try:
-            output = result.get(timeout=10)
-        except multiprocess.context.TimeoutError:
+        # Keep the placeholder up to date with the snippet's place in the queue and the output it has printed so far,
+        # editing it at most every 1.5 seconds to stay within Discord's rate limits
+        position = 0
+        streamed = []
+
+        async def show_progress():
+            title = "Running code..." if position == 0 else f"Queued - position {position}..."
+            embed = discord.Embed(title=title, color=0x2F3136)
+            if streamed:
+                embed.description = "Output so far:\n```python\n{}```".format("".join(streamed)[-1000:])
+            await sent.edit(embed=embed)
+
+        stream = ThrottledUpdate(show_progress, interval=1.5)
+
+        # Only the latest position is shown, the result never waits behind the edits of positions it has passed
+        async def report_position(new_position: int):
+            nonlocal position
+            position = new_position
+            stream.schedule()
+
+        def on_output(chunk: str):
+            streamed.append(chunk)
+            stream.schedule()
+
+        # Check for mistakes that are visible without running the snippet
+        rejection = preflight.check(source)
+
+        # Run the snippets of users with a session in their session's worker, where earlier snippets' globals live on
+        in_session = sessions.active(message.author.id)
+        result = None
+        if rejection is None and in_session:
+            try:
+                result = await sessions.run(message.author.id, source, on_output=on_output)
+            finally:
+                await stream.close()
+
+        # Evaluate trivial snippets right away, and execute the rest in a separate process once it's their turn
+        if rejection is None and not in_session and fast_path_enabled:
+            result = await run_trivial(source, pool.limits.output)
+            if result is not None:
+                fast_path_runs.inc()
+        if rejection is None and not in_session and result is None:
+            try:
+                result = await results.run(source, functools.partial(
+                    scheduler.submit, user=message.author.id, channel=message.channel.id,
+                    on_position=report_position, on_output=on_output))
+            except QueueFull:
+                pass
+            finally:
+                await stream.close()
+
+        if rejection is not None:
+            outcome = "preflight"
+            output = f"Rejected before running - {rejection}"
+
+            # A snippet that would never finish would have held a worker until the timeout, any other
+            # would have taken about as long as snippets usually do
+            total = phase_seconds["total"]
+            preflight_saved_seconds.inc(pool.timeout if rejection.runs_forever or not total.count
+                                        else total.sum / total.count)
+        elif result is None:
+            outcome = "rejected"
+            output = "Too many snippets are waiting to run - please try again in a moment."
+        elif result.timed_out:
+            outcome = "timeout"
             output = "Timeout error - do you have an infinite loop?"
-        except Exception as e:
-            output = "Runtime error: {}".format(e)
+            if result.killed:
+                output += "\n(the sandbox was stopped and replaced)"
+        elif result.limit == "cpu":
+            outcome = "cpu_limit"
+            output = f"CPU limit exceeded - the snippet used more than {pool.limits.cpu}s of CPU time"
+        elif result.limit == "memory" and in_session:
+            outcome = "memory_limit"
+            output = f"Memory limit exceeded - your session tried to use more than {sessions.limits.memory // (1024 * 1024)}MB" \
+                     f" in total, reset it to free its memory"
+        elif result.limit == "memory":
+            outcome = "memory_limit"
+            output = f"Memory limit exceeded - the snippet tried to use more than {pool.limits.memory // (1024 * 1024)}MB"
+        elif result.error is not None:
+            outcome = "error"
+            output = "Runtime error: {}".format(result.error)
+        else:
+            outcome = "ok"
+            output = result.output
+            if result.truncated:
+                output += f"\n... (output truncated after {pool.limits.output // 1024}KB)"
+
+        # Keep whatever was printed before the snippet was stopped
+        if result is not None and (result.timed_out or result.limit) and result.output:
+            output = result.output.rstrip("\n") + "\n" + output
+
+        # The session's globals lived in the worker that was stopped
+        if in_session and result is not None and result.killed:
+            output += "\n(your session ended with it, start a new one with the session command)"
+
+        # Encode shown images, and output too long for the embed, as attachments off the event loop
+        attachments = []
+        images = result.images if result is not None else []
+        if images or len(output) > FIELD_LIMIT:
+            attachments, output = await asyncio.to_thread(render, images, output)
 
         # Record end of runtime
         end_compile = datetime.now()
@@ -254,7 +412,10 @@ async def on_message(message):
         # Log the interpreted code execution
         log_event(
             f"Interpreted code executed by {message.author} in #{message.channel} (took {elapsed_time}):\n" + '\t'*9 + repr(source),
-            "interpret"
+            "interpret",
+            user=str(message.author), channel=str(message.channel),
+            duration_ms=round((end_compile - start_compile).total_seconds() * 1000, 3),
+            source_length=len(source)
         )
 
         # Create an embed for the interpreted code
@@ -266,11 +427,31 @@ async def on_message(message):
                                output or "(no output to stdout)"),
                            inline=False)
         embedded.add_field(name="\u200B",
-                           value=f"took {elapsed_time}",
+                           value=f"took {elapsed_time}" + (" (cached result)" if result is not None and result.cached else "")
+                                 + (" (session)" if in_session else ""),
                            inline=False)
 
+        # Show the first image in the embed, every attachment is listed below it
+        if images:
+            embedded.set_image(url="attachment://image1.png")
+
         # Edit the message to update it with the interpreted code
-        await sent.edit(embed=embedded)
+        start_edit = datetime.now()
+        if attachments:
+            await sent.edit(embed=embedded, files=[discord.File(io.BytesIO(data), filename=name)
+                                                   for name, data in attachments])
+        else:
+            await sent.edit(embed=embedded)
+
+        # Record how long each phase took, results from the cache never reached a worker
+        snippet_outcomes[outcome].inc()
+        phase_seconds["edit"].observe((datetime.now() - start_edit).total_seconds())
+        phase_seconds["total"].observe((end_compile - start_compile).total_seconds())
+        if result is not None and not result.cached:
+            for phase, seconds in result.timings.items():
+                phase_seconds[phase].observe(seconds)
+            if "queue_wait" in result.timings:
+                autoscaler.observe(result.timings["queue_wait"])
 
 
 @bot.event
@@ -284,11 +465,8 @@ async def on_error(event: str, *args, **kwargs):
 @bot.bridge_command(aliases=["stat", "info", "up"], description="Get statistics of Rubber Duck.")
 @logging
 async def stats(ctx):
-    # get the load average in the last 15 minutes
-    _, _, load_15 = psutil.getloadavg()
-
-    # compute average CPU usage based on the number of cores
-    average_usage = (load_15 / os.cpu_count()) * 100
+    # everything below is read from the background sampler, so nothing is measured while the user waits
+    sample = sampler.latest
 
     # create an embedding to hold the stats
     embedded = discord.Embed(title="Rubber Duck / Info", color=0x2F3136)
@@ -298,16 +476,81 @@ async def stats(ctx):
                        value=f"Python version:\n`v{platform.python_version()}`",
                        inline=True)
     embedded.add_field(name="\u200B",
-                       value=f"Rubber Duck Version:\n`{get_git_info()}`",
+                       value=f"Rubber Duck Version:\n`{git_info}`",
                        inline=True)
     embedded.add_field(name="\u200B",
                        value=f"Uptime:\n`{get_uptime()}`",
                        inline=True)
+    if sample is None:
+        embedded.add_field(name="\u200B", value="System usage:\n`no samples yet`", inline=True)
+    else:
+        # add the current usage, with its trend and range over the sampled history
+        cpu = sampler.series(lambda s: s.cpu_percent)
+        load_1, load_5, load_15 = sample.load
+        workers_rss = sampler.series(lambda s: sum(s.worker_rss))
+        utilization = sampler.series(lambda s: s.utilization * 100)
+        rate = sampler.series(lambda s: s.executions_per_minute)
+        embedded.add_field(name="\u200B",
+                           value=f"CPU usage:\n`{sample.cpu_percent:.1f}% (min {min(cpu):.0f}% / max {max(cpu):.0f}%)`"
+                                 f"\n`{sparkline(cpu)}`",
+                           inline=True)
+        embedded.add_field(name="\u200B",
+                           value=f"Load average (1/5/15 min):\n`{load_1:.2f} / {load_5:.2f} / {load_15:.2f}`",
+                           inline=True)
+        embedded.add_field(name="\u200B",
+                           value=f"RAM Used:\n`{(sample.memory_used / 1000000000):.2f}GB ({sample.memory_percent:.1f}%)`",
+                           inline=True)
+        embedded.add_field(name="\u200B",
+                           value=f"Bot / workers RSS:\n`{sample.bot_rss / 1000000:.0f}MB / "
+                                 f"{sum(sample.worker_rss) / 1000000:.0f}MB ({len(sample.worker_rss)} workers)`"
+                                 f"\n`{sparkline(workers_rss)}`",
+                           inline=True)
+        embedded.add_field(name="\u200B",
+                           value=f"Pool utilization:\n`{sample.utilization * 100:.0f}% (max {max(utilization):.0f}%)`"
+                                 f"\n`{sparkline(utilization)}`",
+                           inline=True)
+        embedded.add_field(name="\u200B",
+                           value=f"Snippets per minute:\n`{sample.executions_per_minute:.1f} (max {max(rate):.1f})`"
+                                 f"\n`{sparkline(rate)}`",
+                           inline=True)
+
+    # add the compile cache hit rate of the sandbox workers
+    cache_hits, cache_misses = pool.compile_cache_stats
     embedded.add_field(name="\u200B",
-                       value=f"CPU usage (average):\n`{average_usage:.1f}%`",
+                       value=f"Compile cache:\n`{cache_hits} hits / {cache_misses} misses`",
                        inline=True)
     embedded.add_field(name="\u200B",
-                       value=f"RAM Used:\n`{(psutil.virtual_memory()[3] / 1000000000):.2f}GB ({psutil.virtual_memory()[2]:.1f}%)`",
+                       value=f"Pre-flight:\n`{snippet_outcomes['preflight'].value} rejected, "
+                             f"~{preflight_saved_seconds.value:.0f}s of worker time saved`",
+                       inline=True)
+    embedded.add_field(name="\u200B",
+                       value=f"Result cache:\n`{results.hits + results.coalesced} reused / {results.misses} run`",
+                       inline=True)
+
+    # add the latency percentiles of interpreted snippets
+    embedded.add_field(name="\u200B",
+                       value=f"Latency p50/p95/p99:\n`{format_quantiles(phase_seconds['total'])}`",
+                       inline=True)
+    embedded.add_field(name="\u200B",
+                       value=f"Queue wait p50/p95/p99:\n`{format_quantiles(phase_seconds['queue_wait'])}`",
+                       inline=True)
+    embedded.add_field(name="\u200B",
+                       value=f"Execution p50/p95/p99:\n`{format_quantiles(phase_seconds['execute'])}`",
+                       inline=True)
+
+    # add the pool's size and the autoscaler's latest decision, or the executor's health when it runs the pool
+    last_change = "no changes yet"
+    if EXECUTOR_SOCKET:
+        last_change = (f"executor up {humanize.naturaldelta(pool.last_health['uptime'])}, "
+                       f"{pool.last_health['connections']} connections" if pool.healthy else "executor unreachable")
+    elif autoscaler.decisions:
+        decision = autoscaler.decisions[-1]
+        last_change = (f"{decision.old_size} → {decision.new_size} "
+                       f"{humanize.naturaltime(datetime.now() - datetime.fromtimestamp(decision.time))}, "
+                       f"{decision.reason}")
+    embedded.add_field(name="\u200B",
+                       value=f"Sandbox workers ({autoscaler.min_size}-{autoscaler.max_size}):\n`{pool.size}`"
+                             f"\n`{last_change}`",
                        inline=True)
 
     # set the author and footer of the embedding
@@ -362,9 +605,9 @@ async def restart(ctx):
             text=f"Rubber Duck - Restart failed @ {date.today()}")
         await ctx.reply(embed=embedded)
 
-@bot.bridge_command(description="Sends the last n lines of the log file.")
+@bot.bridge_command(description="Sends the last n lines of the logs, e.g. logs 10 user:<name> type:error from:2024-01-31")
 @logging
-async def logs(ctx, n: int = 5):
+async def logs(ctx, *, query: str = "5"):
     if ctx.author.id != 291050399509774340 and ctx.author.id != 318811766656204830:
         # If the user does not have the correct ID, send an error message
         embedded = discord.Embed(
@@ -377,29 +620,77 @@ async def logs(ctx, n: int = 5):
         await ctx.reply(embed=embedded)
         return
 
-    # Try current day's log first, then previous day if needed
-    for days_ago in [0, 1]:
-        log_date = (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%d')
-        log_file_path = f"{LOG_LOCATION}/{log_date}/log.txt"
-        
-        if os.path.exists(log_file_path):
-            # Read the last n lines from the log file
-            with open(log_file_path, "r") as f:
-                lines = f.readlines()[-n:]
-            
-            # Create an embedded message with the log content
-            embedded = discord.Embed(title="Rubber Duck / Logs", color=0x2F3136)
-            embedded.set_author(name="Rubber Duck / Logs",
-                                url="https://en.wikipedia.org/wiki/Rubber_duck_debugging",
-                                icon_url="https://cdn.discordapp.com/avatars/1047186063606698016/5f73a9caae675ae8d403adaab8f50a8e.webp?size=64")
-            embedded.set_footer(text=f"Rubber Duck - Logs @ {date.today()}")
-            embedded.description = "".join(lines)
-            
-            await ctx.reply(embed=embedded)
-            return
-    
-    # If no log files were found
-    await ctx.reply(embed=discord.Embed(title="Log file not found.", color=0x2F3136))
+    # Parse the query: a number of lines, and optionally user:<name>, type:<event type>,
+    # and date:, from: or to: followed by a YYYY-MM-DD date
+    n, filters = 5, {}
+    for token in query.split():
+        key, _, value = token.partition(":")
+        if token.isdigit():
+            n = int(token)
+        elif key in ("user", "type", "date", "from", "to") and value:
+            filters[key] = value
+
+    # Search the logs off the event loop, reading backwards from the newest entries
+    lines = await asyncio.to_thread(
+        search_logs, LOG_LOCATION, n,
+        user=filters.get("user", ""), event_type=filters.get("type", ""),
+        since=filters.get("date", filters.get("from", "")), until=filters.get("date", filters.get("to", "")),
+        extension=log_writer.extension)
+
+    # If no log entries were found
+    if not lines:
+        await ctx.reply(embed=discord.Embed(title="No matching log entries found.", color=0x2F3136))
+        return
+
+    # Create an embedded message with the log content, keeping the newest lines that fit
+    embedded = discord.Embed(title="Rubber Duck / Logs", color=0x2F3136)
+    embedded.set_author(name="Rubber Duck / Logs",
+                        url="https://en.wikipedia.org/wiki/Rubber_duck_debugging",
+                        icon_url="https://cdn.discordapp.com/avatars/1047186063606698016/5f73a9caae675ae8d403adaab8f50a8e.webp?size=64")
+    embedded.set_footer(text=f"Rubber Duck - Logs @ {date.today()}")
+    embedded.description = "".join(lines)[-4000:]
+
+    await ctx.reply(embed=embedded)
+
+@bot.bridge_command(aliases=["repl"], description="Keep your globals between snippets: session start|stop|reset|info")
+@logging
+async def session(ctx, action: str = "info"):
+    user = ctx.author.id
+    embedded = discord.Embed(title="Rubber Duck / Session", color=0x2F3136)
+    embedded.set_author(name="Rubber Duck / Session",
+                        url="https://en.wikipedia.org/wiki/Rubber_duck_debugging",
+                        icon_url="https://cdn.discordapp.com/avatars/1047186063606698016/5f73a9caae675ae8d403adaab8f50a8e.webp?size=64")
+    embedded.set_footer(text=f"Rubber Duck - Input from {ctx.author} ・ {date.today()}")
+
+    if action == "start":
+        try:
+            sessions.start(user)
+            embedded.description = ("Session started - your `>>` snippets now share their globals, so imports and "
+                                    f"variables carry over. It ends after {sessions.idle_timeout // 60:.0f} idle minutes.")
+            log_event(f"session of user {user} started", "session", user=str(user))
+        except SessionsFull:
+            embedded.description = "Every session is busy right now - please try again in a moment."
+    elif action == "stop":
+        sessions.stop(user)
+        embedded.description = "Session stopped - your snippets run in a fresh namespace again."
+    elif not sessions.active(user):
+        embedded.description = "You don't have a session - start one with `session start`."
+    elif action == "reset":
+        await sessions.reset(user)
+        embedded.description = "Session reset - its globals have been cleared."
+    else:
+        # List the session's globals, keeping within the embed's size limit
+        try:
+            names, memory, runs = await sessions.inspect(user)
+        except RuntimeError as e:
+            embedded.description = f"Could not inspect the session: {e}"
+        else:
+            listing = "\n".join(f"{name}: {kind} = {preview}" for name, kind, preview in names) or "(no globals yet)"
+            embedded.description = (f"{runs} snippets run, {memory / 1024 ** 2:.1f}MB of "
+                                    f"{sessions.limits.memory // 1024 ** 2}MB used\n```python\n{listing[:3800]}```")
+
+    await ctx.reply(embed=embedded)
+
 
 @bot.bridge_command(aliases=["shutdown"], description="Stops the bot.")
 @logging
@@ -440,7 +731,9 @@ async def help(ctx):
     command_list = [
         {"name": "stats", "aliases": [
             "stat", "info", "up"], "desc": "Get statistics of Rubber Duck."},
-        {"name": "restart", "aliases": ["rs"], "desc": "Restart the docker instance."}, {
+        {"name": "restart", "aliases": ["rs"], "desc": "Restart the docker instance."},
+        {"name": "session", "aliases": ["repl"],
+         "desc": "Keep your globals between snippets: session start, stop, reset or info."}, {
             "name": "ping", "aliases": ["latency"], "desc": "Sends the bot's latency."}
     ]
 
@@ -454,7 +747,8 @@ async def help(ctx):
 
     # Add a field to the message with information about using the interpreter
     embedded.add_field(name="Interpreter",
-                       value="To run the python interpreter prefix any python code (including code-blocks) with >> to run the interpreter\n\ni.e.: >> print('hello, world!')",
+                       value="To run the python interpreter prefix any python code (including code-blocks) with >> to run the interpreter\n\ni.e.: >> print('hello, world!')"
+                             "\n\nPass a Pillow image, pygame surface or numpy array to show() to attach it as a picture",
                        inline=False)
 
     # Set the author of the message
@@ -484,4 +778,8 @@ async def ping(ctx):
 
 # Run bot
 if __name__ == "__main__":
-    bot.run(os.getenv("TOKEN"))
\ No newline at end of file
+    try:
+        bot.run(os.getenv("TOKEN"))
+    finally:
+        # Flush the logs written since the last batch
+        log_writer.close()
\ No newline at end of file
@@ -0,0 +1,138 @@
+import asyncio
+import bisect
+from typing import Callable, Dict, Optional, Tuple
+
+# default histogram buckets in seconds, from a millisecond up to the longest a snippet can take
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labels: Dict[str, str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels.items()) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Counter:
+    """A value that only goes up, either counted here or read from a counter kept elsewhere"""
+    kind = "counter"
+
+    def __init__(self, labels: Dict[str, str], read: Optional[Callable[[], float]] = None):
+        self.labels = labels
+        self.read = read
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self, name: str):
+        yield f"{name}{_format_labels(self.labels)}", self.read() if self.read else self.value
+
+
+class Gauge:
+    """A value read from a callback whenever the metrics are collected"""
+    kind = "gauge"
+
+    def __init__(self, labels: Dict[str, str], read: Callable[[], float]):
+        self.labels = labels
+        self.read = read
+
+    def samples(self, name: str):
+        yield f"{name}{_format_labels(self.labels)}", self.read()
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, and estimates quantiles from them"""
+    kind = "histogram"
+
+    def __init__(self, labels: Dict[str, str], buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate the q-quantile by interpolating inside the bucket it falls in, like Prometheus does"""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                # Past the last bucket all we know is the largest bound
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def samples(self, name: str):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{name}_bucket{_format_labels(self.labels, ('le', le))}", cumulative
+        yield f"{name}_sum{_format_labels(self.labels)}", self.sum
+        yield f"{name}_count{_format_labels(self.labels)}", self.count
+
+
+class MetricsRegistry:
+    """Holds every metric of the bot and renders them in the Prometheus text format"""
+
+    def __init__(self, prefix: str = "rubber_duck"):
+        self.prefix = prefix
+        self._families = {}
+
+    def _register(self, name: str, help_text: str, metric):
+        name = f"{self.prefix}_{name}"
+        family = self._families.setdefault(name, {"help": help_text, "kind": metric.kind, "metrics": {}})
+        key = tuple(sorted(metric.labels.items()))
+        return family["metrics"].setdefault(key, metric)
+
+    def counter(self, name: str, help_text: str, read: Optional[Callable[[], float]] = None, **labels) -> Counter:
+        return self._register(name, help_text, Counter(labels, read))
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], float], **labels) -> Gauge:
+        return self._register(name, help_text, Gauge(labels, read))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+                  **labels) -> Histogram:
+        return self._register(name, help_text, Histogram(labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for name, family in self._families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            for metric in family["metrics"].values():
+                lines.extend(f"{sample} {value}" for sample, value in metric.samples(name))
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer a single HTTP request, /metrics gets the metrics and anything else a 404"""
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            parts = request.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port: int, host: str = "127.0.0.1") -> asyncio.AbstractServer:
+        """Serve the metrics over HTTP for a local Prometheus to scrape"""
+        return await asyncio.start_server(self._handle, host, port)
@@ -0,0 +1,271 @@
+import ast
+import hashlib
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from sandbox import Limits, _SAFE_MODULES
+
+# a loop over more items than this can't finish within any sensible timeout, even with an empty body
+MAX_ITERATIONS = 10 ** 9
+
+# constants past this size aren't folded, so the analysis itself stays cheap
+_FOLD_BITS = 4096
+
+# exceptions that catch the Exception the sandbox raises for an import of a module that isn't whitelisted
+_IMPORT_ERRORS = frozenset(("Exception", "BaseException"))
+
+# constant calls that turn a range into a collection, holding a pointer per item
+_MATERIALIZERS = frozenset(("list", "tuple", "set", "sorted", "frozenset"))
+
+
+@dataclass(frozen=True)
+class Rejection:
+    """Why a snippet was turned away before running, and whether it would have run until the timeout"""
+    line: int
+    message: str
+    kind: str
+    runs_forever: bool = False
+
+    def __str__(self):
+        return f"Line {self.line}: {self.message}"
+
+
+class _TooLarge(Exception):
+    """Raised when a constant expression would take more memory than a snippet may use"""
+
+    def __init__(self, bits: float):
+        self.bits = bits
+
+
+def _fold(tree: ast.AST, max_bits: int) -> dict:
+    """Fold every expression made of small integer literals in one pass, children before their parents, mapping
+    each to its value, or to a _TooLarge if the result would take more than max_bits"""
+    constants = {}
+
+    # Each node comes after its parent in a walk, so in reverse its operands are always folded first
+    for node in reversed(list(ast.walk(tree))):
+        if isinstance(node, ast.Constant):
+            if type(node.value) is int:
+                constants[node] = node.value
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            value = constants.get(node.operand)
+            if isinstance(value, int) and isinstance(node.op, ast.USub):
+                value = -value
+            if value is not None:
+                constants[node] = value
+        elif isinstance(node, ast.BinOp):
+            value = _fold_binop(node, constants.get(node.left), constants.get(node.right), max_bits)
+            if value is not None:
+                constants[node] = value
+    return constants
+
+
+def _fold_binop(node: ast.BinOp, left, right, max_bits: int):
+    """Fold a binary operation on already folded operands"""
+    if isinstance(left, _TooLarge):
+        return left
+    if isinstance(right, _TooLarge):
+        return right
+    if left is None or right is None:
+        return None
+    if isinstance(node.op, ast.Pow):
+        if right < 0:
+            return None
+        # Estimate the size of the result before computing it
+        bits = right * math.log2(abs(left)) if abs(left) > 1 else 1
+    elif isinstance(node.op, ast.Mult):
+        bits = left.bit_length() + right.bit_length()
+    elif isinstance(node.op, ast.Add):
+        return left + right
+    elif isinstance(node.op, ast.Sub):
+        return left - right
+    else:
+        return None
+
+    if bits > max_bits:
+        return _TooLarge(bits)
+    if bits > _FOLD_BITS:
+        return None
+    return left ** right if isinstance(node.op, ast.Pow) else left * right
+
+
+def _constant_int(node: ast.AST, constants: dict) -> Optional[int]:
+    """The folded value of an expression, or None if it isn't a small integer one, raising _TooLarge if the result
+    would take more memory than a snippet may use"""
+    value = constants.get(node)
+    if isinstance(value, _TooLarge):
+        raise value
+    return value
+
+
+def _range_length(node: ast.Call, constants: dict) -> Optional[int]:
+    """Length of a range() call with constant arguments"""
+    args = [_constant_int(arg, constants) for arg in node.args]
+    if not 1 <= len(args) <= 3 or None in args or node.keywords:
+        return None
+    if len(args) == 3 and args[2] == 0:
+        return None
+    return len(range(*args))
+
+
+def _exits(loop: ast.stmt) -> bool:
+    """Check whether anything in the loop's body can leave it other than an exception"""
+    todo = list(loop.body)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.Return, ast.Raise, ast.Yield, ast.YieldFrom, ast.Await)):
+            return True
+        # A break only counts if it belongs to this loop, and nested functions run on their own
+        if isinstance(node, ast.Break):
+            return True
+        if isinstance(node, (ast.For, ast.AsyncFor, ast.While)):
+            todo.extend(node.orelse)
+            todo.extend(child for statement in node.body for child in ast.walk(statement)
+                        if isinstance(child, (ast.Return, ast.Raise, ast.Yield, ast.YieldFrom, ast.Await)))
+            continue
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+            continue
+        todo.extend(ast.iter_child_nodes(node))
+    return False
+
+
+def _catches(handler: ast.ExceptHandler, names: Optional[frozenset]) -> bool:
+    """Whether the handler catches one of the named exceptions, or any exception if names is None"""
+    if handler.type is None or names is None:
+        return True
+    types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+    return any(isinstance(t, ast.Name) and t.id in names for t in types)
+
+
+def _guarded(node: ast.AST, parents: dict, names: Optional[frozenset] = None) -> bool:
+    """Whether an exception raised at the node may be caught, by a try around it with a handler for one of the
+    named exceptions, or in the caller of the function it is in"""
+    while node in parents:
+        parent = parents[node]
+        if isinstance(parent, ast.Try) and node in parent.body \
+                and any(_catches(handler, names) for handler in parent.handlers):
+            return True
+        if isinstance(parent, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            return True
+        node = parent
+    return False
+
+
+def _always_true(test: ast.AST) -> bool:
+    return isinstance(test, ast.Constant) and bool(test.value) and not isinstance(test.value, (str, bytes))
+
+
+def analyze(source: str, limits: Limits = Limits()) -> Optional[Rejection]:
+    """Find the first reason the snippet can't succeed that is visible without running it"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        return Rejection(e.lineno or 1, f"SyntaxError: {e.msg}", "syntax")
+    except (RecursionError, MemoryError):
+        # Nested too deeply for the parser, which the sandbox's compile will report
+        return None
+
+    constants = _fold(tree, limits.memory * 8)
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+    for node in ast.walk(tree):
+        line = getattr(node, "lineno", 1)
+
+        # The same check the sandbox's __import__ makes, the full dotted name has to be whitelisted. It raises a plain
+        # Exception, so only an import whose failure is caught as one can be left to run
+        if isinstance(node, (ast.Import, ast.ImportFrom)) and _guarded(node, parents, _IMPORT_ERRORS):
+            continue
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name not in _SAFE_MODULES:
+                    return Rejection(line, f"{alias.name} is not a supported module.", "import")
+        elif isinstance(node, ast.ImportFrom):
+            if node.level or node.module not in _SAFE_MODULES:
+                name = "." * node.level + (node.module or "")
+                return Rejection(line, f"{name} is not a supported module.", "import")
+
+        # An exception may end the loop too if something catches it
+        elif isinstance(node, ast.While) and _always_true(node.test) and not _exits(node) \
+                and not _guarded(node, parents):
+            return Rejection(line, "this loop never ends, nothing in it breaks out of it or returns", "loop",
+                             runs_forever=True)
+
+        elif isinstance(node, ast.BinOp):
+            try:
+                _constant_int(node, constants)
+            except _TooLarge as e:
+                return Rejection(line, f"this number would take about {e.bits / 8 / 2 ** 20:,.0f}MB, "
+                                       f"more than the {limits.memory // 2 ** 20}MB a snippet may use", "allocation")
+
+            # Repeating a literal sequence, e.g. [0] * 10**10
+            if isinstance(node.op, ast.Mult):
+                for sequence, count in ((node.left, node.right), (node.right, node.left)):
+                    if isinstance(sequence, (ast.List, ast.Tuple)):
+                        item_size, length = 8, len(sequence.elts)
+                    elif isinstance(sequence, ast.Constant) and isinstance(sequence.value, (str, bytes)):
+                        item_size, length = 1, len(sequence.value)
+                    else:
+                        continue
+                    try:
+                        count = _constant_int(count, constants)
+                    except _TooLarge:
+                        count = None
+                    if count is not None and item_size * length * count > limits.memory:
+                        return Rejection(line, f"this sequence would take about "
+                                               f"{item_size * length * count / 2 ** 20:,.0f}MB, more than the "
+                                               f"{limits.memory // 2 ** 20}MB a snippet may use", "allocation")
+
+        # Iterating over a range this long won't finish in time, unless the loop can be left early. Generator
+        # expressions are only iterated as far as their consumer goes
+        elif (isinstance(node, ast.For) and not _exits(node) and not _guarded(node, parents)
+              or isinstance(node, ast.comprehension) and not isinstance(parents[node], ast.GeneratorExp)) \
+                and isinstance(node.iter, ast.Call) and isinstance(node.iter.func, ast.Name) \
+                and node.iter.func.id == "range":
+            try:
+                length = _range_length(node.iter, constants)
+            except _TooLarge:
+                length = None
+            if length is not None and length > MAX_ITERATIONS:
+                return Rejection(getattr(node.iter, "lineno", line), f"a loop over {length:,} items is too long to "
+                                                                     f"finish in time", "range", runs_forever=True)
+
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            # Materializing a range holds a pointer per item
+            if node.func.id in _MATERIALIZERS and len(node.args) == 1 and isinstance(node.args[0], ast.Call) \
+                    and isinstance(node.args[0].func, ast.Name) and node.args[0].func.id == "range":
+                try:
+                    length = _range_length(node.args[0], constants)
+                except _TooLarge:
+                    length = None
+                if length is not None and length * 8 > limits.memory:
+                    return Rejection(line, f"this {node.func.id} of {length:,} items would take more than the "
+                                           f"{limits.memory // 2 ** 20}MB a snippet may use", "allocation")
+
+    return None
+
+
+class Preflight:
+    """Analyzes snippets before they are queued, remembering the verdicts on recent sources"""
+
+    def __init__(self, limits: Limits = Limits(), size: int = 1024):
+        self.limits = limits
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def check(self, source: str) -> Optional[Rejection]:
+        """Return why the snippet would fail, or None if it is worth running"""
+        key = hashlib.sha256(source.encode()).digest()
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+
+        rejection = analyze(source, self.limits)
+        self._entries[key] = rejection
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return rejection
@@ -0,0 +1,110 @@
+import ast
+import asyncio
+import dataclasses
+import functools
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from sandbox import ExecutionResult
+
+# modules whose results can't change between two runs of the same snippet
+_DETERMINISTIC_MODULES = frozenset(("math",))
+
+# builtins the sandbox provides whose results differ between runs, random and whrandom are modules needing no import
+_NONDETERMINISTIC_NAMES = frozenset(("random", "whrandom", "id", "hash", "__import__"))
+
+
+def normalize(source: str) -> str:
+    """Normalize line endings and surrounding whitespace without moving any line of the snippet"""
+    lines = [line.rstrip() for line in source.replace("\r\n", "\n").split("\n")]
+    return "\n".join(lines).strip("\n")
+
+
+def is_deterministic(source: str) -> bool:
+    """Check whether the snippet only imports modules and uses builtins that can't make its output vary between runs"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        # Let the sandbox produce the error message
+        return False
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in _NONDETERMINISTIC_NAMES:
+            return False
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            names = [node.module or ""]
+        else:
+            continue
+        if any(name.split(".")[0] not in _DETERMINISTIC_MODULES for name in names):
+            return False
+    return True
+
+
+class ResultCache:
+    """Reuses the results of deterministic snippets and shares one execution between identical concurrent ones"""
+
+    def __init__(self, size: int = 512, ttl: float = 600):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def _get(self, key: str) -> Optional[ExecutionResult]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return result
+
+    def _put(self, key: str, result: ExecutionResult):
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    async def run(self, source: str, execute: Callable[[str], Awaitable[ExecutionResult]]) -> ExecutionResult:
+        """Return a cached or shared result for the snippet if possible, otherwise execute it"""
+        key = normalize(source)
+        if not is_deterministic(key):
+            return await execute(source)
+
+        result = self._get(key)
+        if result is not None:
+            self.hits += 1
+            return dataclasses.replace(result, cached=True)
+
+        # Piggyback on an identical snippet that is already running
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return dataclasses.replace(await asyncio.shield(task), cached=True)
+
+        # Run the snippet in its own task so that cancelling this caller doesn't fail the others waiting on it
+        self.misses += 1
+        task = asyncio.ensure_future(execute(source))
+        self._in_flight[key] = task
+        task.add_done_callback(functools.partial(self._finish, key))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        """Stop sharing a finished execution and remember its result"""
+        del self._in_flight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        # Timeouts and crashes say more about the worker than the snippet, so they aren't reused
+        result = task.result()
+        if not result.timed_out and not result.killed:
+            self._put(key, result)
@@ -0,0 +1,744 @@
+import asyncio
+import functools
+import glob
+import hashlib
+import importlib
+import itertools
+import math
+import mmap
+import os
+import reprlib
+import resource
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Callable, Optional, Tuple
+
+import multiprocess
+import psutil
+from multiprocess.connection import Connection
+import RestrictedPython
+from RestrictedPython import compile_restricted, limited_builtins, safe_builtins, utility_builtins
+from RestrictedPython.PrintCollector import PrintCollector
+
+# list of supported modules (refer to requirements.txt)
+_SAFE_MODULES = frozenset(("math", "numpy", "requests",
+                          "pillow", "PIL", "asyncio", "pygame", "scipy", "pandas"))
+
+
+# modules imported by the template process, so that workers forked from it start with them loaded
+_PRELOAD_MODULES = tuple(sorted(set({"pillow": "PIL.Image", "PIL": "PIL.Image"}.get(name, name) for name in _SAFE_MODULES)))
+
+# where workers hand pixel buffers to the bot, /dev/shm is shared memory that the bot reads without any pickling
+_SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# most images a snippet may show, and the most pixel data each of them may hold
+MAX_IMAGES = 4
+MAX_IMAGE_BYTES = 16 * 1024 * 1024
+
+# numbers the shared memory files of this worker
+_image_numbers = itertools.count()
+
+
+# function for calling __import__ in the safe environment
+def _safe_import(name, *args, **kwargs):
+    if name not in _SAFE_MODULES:
+        raise Exception(f"{name} is not a supported module.")
+    return __import__(name, *args, **kwargs)
+
+
+@dataclass(frozen=True)
+class Limits:
+    """Resources a single snippet may use on top of what its worker already holds"""
+    memory: int = 100 * 1024 * 1024
+    cpu: int = 5
+    output: int = 64 * 1024
+
+
+class CPULimitExceeded(BaseException):
+    """Raised inside a snippet that used up its CPU time (a BaseException so `except Exception` can't swallow it)"""
+
+
+def _cpu_limit_exceeded(signum, frame):
+    raise CPULimitExceeded()
+
+
+# how often a worker sends the text printed so far back to the supervisor
+STREAM_INTERVAL = 0.25
+
+
+class _OutputStream:
+    """Sends printed text back to the supervisor in chunks while the snippet is still running"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+        self._pending = []
+
+        # Flush from a separate thread, so text printed just before a long computation isn't held back
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def write(self, text: str):
+        with self._lock:
+            self._pending.append(text)
+
+    def _flush(self):
+        if self._pending:
+            self.conn.send({"chunk": "".join(self._pending)})
+            self._pending.clear()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(STREAM_INTERVAL)
+            with self._lock:
+                self._flush()
+
+    def send(self, reply: dict):
+        """Send the final reply, after whatever text is still pending"""
+        with self._lock:
+            self._flush()
+
+            # Lets the supervisor time how long the reply took to pickle and cross the pipe
+            reply["sent_at"] = time.time()
+            self.conn.send(reply)
+
+
+class _OutputBudget:
+    """The number of bytes a snippet may still print, shared by every print collector of one run"""
+
+    def __init__(self, limit: int, stream: Optional[_OutputStream] = None):
+        self.remaining = limit
+        self.truncated = False
+        self.stream = stream
+
+
+class _BoundedPrintCollector(PrintCollector):
+    """A print collector that stops buffering once the run's output budget is spent"""
+
+    def __init__(self, budget: _OutputBudget, _getattr_=None):
+        super().__init__(_getattr_)
+        self.budget = budget
+
+    def write(self, text):
+        if self.budget.truncated:
+            return
+
+        size = len(text.encode())
+        if size > self.budget.remaining:
+            # Keep what still fits, cutting on a character boundary
+            text = text.encode()[:self.budget.remaining].decode(errors="ignore")
+            self.budget.truncated = True
+        self.budget.remaining -= size
+        super().write(text)
+        if self.budget.stream is not None:
+            self.budget.stream.write(text)
+
+
+@dataclass(frozen=True)
+class CapturedImage:
+    """Pixels a snippet passed to show(), with mode "L", "RGB" or "RGBA" as in Pillow"""
+    width: int
+    height: int
+    mode: str
+    pixels: bytes
+
+
+def _to_pixels(obj):
+    """Turn a Pillow image, pygame surface or numpy array into an array of 8-bit pixels"""
+    import numpy
+
+    if type(obj).__module__.startswith("PIL.") and hasattr(obj, "getbands"):
+        array = numpy.asarray(obj.convert("RGBA" if "A" in obj.getbands() or obj.mode == "P" else "RGB"))
+    elif type(obj).__module__.startswith("pygame") and hasattr(obj, "get_size"):
+        import pygame.surfarray
+        array = pygame.surfarray.array3d(obj).transpose(1, 0, 2)
+    else:
+        array = numpy.asarray(obj)
+
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    if array.ndim not in (2, 3) or (array.ndim == 3 and array.shape[2] not in (3, 4)):
+        raise ValueError("show() takes an image, or an array shaped (height, width), (height, width, 3) "
+                         "or (height, width, 4)")
+    if array.size > MAX_IMAGE_BYTES:
+        raise ValueError(f"show() takes images of at most {MAX_IMAGE_BYTES // 2 ** 20}MB of pixels")
+
+    # Booleans are black and white, floats from 0 to 1 are scaled, anything else is clipped to a byte
+    if array.dtype == bool:
+        array = array * 255
+    elif array.dtype.kind == "f" and array.size and array.max() <= 1:
+        array = array * 255
+    return numpy.ascontiguousarray(numpy.clip(array, 0, 255).astype(numpy.uint8))
+
+
+def _show(images: list, obj):
+    """Hand an image to the bot through a shared memory file, keeping only its name and shape in the reply"""
+    if len(images) >= MAX_IMAGES:
+        raise ValueError(f"a snippet can show at most {MAX_IMAGES} images")
+
+    pixels = _to_pixels(obj)
+    path = f"{_SHARED_MEMORY_DIR}/rubber_duck_{os.getpid()}_{next(_image_numbers)}"
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        os.ftruncate(fd, max(pixels.nbytes, 1))
+        with mmap.mmap(fd, max(pixels.nbytes, 1)) as buffer:
+            buffer[:pixels.nbytes] = memoryview(pixels).cast("B")
+    finally:
+        os.close(fd)
+    images.append({"path": path, "shape": pixels.shape})
+
+
+def _release_images(shown: list):
+    """Remove the shared memory files of images nobody is going to read"""
+    for image in shown:
+        try:
+            os.unlink(image["path"])
+        except FileNotFoundError:
+            pass
+
+
+def _collect_images(shown: list) -> list:
+    """Read the images a worker showed out of shared memory, and release it"""
+    images = []
+    for image in shown:
+        try:
+            with open(image["path"], "rb") as f:
+                pixels = f.read()
+        finally:
+            os.unlink(image["path"])
+        height, width = image["shape"][:2]
+        mode = "L" if len(image["shape"]) == 2 else ("RGB" if image["shape"][2] == 3 else "RGBA")
+        images.append(CapturedImage(width, height, mode, pixels[:width * height * len(mode)]))
+    return images
+
+
+# the restricted builtins every snippet runs with, built once and copied into each run's globals
+_SAFE_BUILTINS = MappingProxyType({
+    **limited_builtins,
+    **safe_builtins,
+    **utility_builtins,
+    "all": all,
+    "any": any,
+    "_getiter_": RestrictedPython.Eval.default_guarded_getiter,
+    "_iter_unpack_sequence_": RestrictedPython.Guards.guarded_iter_unpack_sequence,
+    "__import__": _safe_import
+})
+
+# number of compiled snippets each worker keeps around
+COMPILE_CACHE_SIZE = 256
+
+
+class _CompileCache:
+    """A bounded LRU cache of restricted code objects, keyed by a hash of their source"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def compile(self, code: str):
+        key = hashlib.sha256(code.encode()).digest()
+        byte_code = self._entries.get(key)
+        if byte_code is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return byte_code
+        self.misses += 1
+
+        # Compile the code using RestrictedPython, a syntax error propagates and is never cached
+        byte_code = compile_restricted(
+            code,
+            filename="<string>",
+            mode="exec",
+        )
+        self._entries[key] = byte_code
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return byte_code
+
+
+# every worker process fills its own copy of the cache
+_compile_cache = _CompileCache(COMPILE_CACHE_SIZE)
+
+
+def interpret(code: str, output_limit: int = Limits.output, stream: Optional[_OutputStream] = None,
+              timings: Optional[dict] = None, namespace: Optional[dict] = None,
+              images: Optional[list] = None) -> Tuple[str, bool]:
+    """Interpret the given code in a safe execution environment and return the results, and whether they were cut short,
+    keeping the snippet's globals in namespace if one is given and what it passed to show() in images"""
+    timings = {} if timings is None else timings
+    images = [] if images is None else images
+
+    # Append the code to collect the printed output
+    code += "\nresults = printed"
+
+    # Reuse the compiled code if this worker has seen the snippet before
+    start = time.perf_counter()
+    byte_code = _compile_cache.compile(code)
+    timings["compile"] = time.perf_counter() - start
+
+    # Create a safe execution environment
+    budget = _OutputBudget(output_limit, stream)
+    data = {} if namespace is None else namespace
+    data.update({
+        "_print_": functools.partial(_BoundedPrintCollector, budget),
+        "__builtins__": dict(_SAFE_BUILTINS, show=functools.partial(_show, images)),
+        "_getattr_": RestrictedPython.Guards.safer_getattr,
+    })
+
+    # Execute the code in the safe environment
+    start = time.perf_counter()
+    try:
+        exec(byte_code, data, None)
+    finally:
+        timings["execute"] = time.perf_counter() - start
+
+    # Return the printed output, it is collected afresh by the next snippet of a session
+    return data.pop("results"), budget.truncated
+
+
+def _interpret_limited(code: str, limits: Limits, stream: _OutputStream, timings: dict,
+                       namespace: Optional[dict] = None, memory_base: Optional[int] = None,
+                       images: Optional[list] = None) -> Tuple[str, bool]:
+    """Run interpret() with the worker's CPU time and address space capped for the duration of the snippet,
+    a session's memory is capped from where it started (memory_base) rather than per snippet"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_soft, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+    memory_soft, memory_hard = resource.getrlimit(resource.RLIMIT_AS)
+
+    # Both limits count everything the process has used so far, so they're set relative to that
+    cpu_limit = math.ceil(usage.ru_utime + usage.ru_stime) + limits.cpu
+    memory_limit = (psutil.Process().memory_info().vms if memory_base is None else memory_base) + limits.memory
+    if cpu_hard != resource.RLIM_INFINITY:
+        cpu_limit = min(cpu_limit, cpu_hard)
+    if memory_hard != resource.RLIM_INFINITY:
+        memory_limit = min(memory_limit, memory_hard)
+
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_hard))
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_hard))
+    try:
+        return interpret(code, limits.output, stream, timings, namespace, images)
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft, cpu_hard))
+        resource.setrlimit(resource.RLIMIT_AS, (memory_soft, memory_hard))
+
+
+@dataclass
+class ExecutionResult:
+    """The outcome of running a snippet in a sandbox worker"""
+    output: str = ""
+    error: Optional[str] = None
+    timed_out: bool = False
+    killed: bool = False
+    cached: bool = False
+    # "cpu" or "memory" if the snippet was stopped by that resource limit
+    limit: Optional[str] = None
+    truncated: bool = False
+    # seconds spent in each phase of the run, e.g. "compile", "execute" and "transfer"
+    timings: dict = field(default_factory=dict)
+    # images the snippet passed to show(), or the {"path", "shape"} of their shared memory files if the pool leaves
+    # collecting them to another process
+    images: list = field(default_factory=list)
+
+
+def _describe(namespace: dict) -> list:
+    """Name, type and a short preview of each global a session's snippets have defined"""
+    preview = reprlib.Repr()
+    preview.maxstring = preview.maxother = 60
+    return [(name, type(value).__name__, " ".join(preview.repr(value).split()))
+            for name, value in namespace.items() if not name.startswith("_")]
+
+
+def _worker_main(conn):
+    """Serve requests received over the pipe until the supervisor closes it: "run" a snippet in a fresh namespace,
+    run it in the worker's "session" namespace, which outlives the snippet, or "inspect" that namespace"""
+    signal.signal(signal.SIGXCPU, _cpu_limit_exceeded)
+    stream = _OutputStream(conn)
+
+    # globals kept between the snippets of a session, and the address space it started with
+    session = None
+    session_base = None
+
+    while True:
+        try:
+            kind, source, limits = conn.recv()
+        except EOFError:
+            break
+
+        # Send back the printed output, or whatever stopped the snippet, along with this worker's compile cache counts
+        reply = {"status": "ok", "output": "", "truncated": False, "timings": {}, "images": []}
+        if kind == "session" and session is None:
+            session, session_base = {}, psutil.Process().memory_info().vms
+        try:
+            if kind == "inspect":
+                reply["names"] = _describe(session or {})
+                reply["memory"] = psutil.Process().memory_info().vms - session_base if session is not None else 0
+            else:
+                namespace, base = (session, session_base) if kind == "session" else (None, None)
+                reply["output"], reply["truncated"] = _interpret_limited(source, limits, stream, reply["timings"],
+                                                                         namespace, base, reply["images"])
+        except CPULimitExceeded:
+            reply["status"] = "cpu"
+        except MemoryError:
+            reply["status"] = "memory"
+        except Exception as e:
+            reply["status"], reply["output"] = "error", str(e)
+        reply["compile_counts"] = (_compile_cache.hits, _compile_cache.misses)
+        stream.send(reply)
+
+
+def _template_main(sock: socket.socket, supervisor_sock: socket.socket):
+    """Import the whitelisted modules once, then fork a fresh sandbox worker whenever the supervisor asks"""
+    # Only the supervisor may hold its end, otherwise we'd never notice it going away
+    supervisor_sock.close()
+
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    for name in _PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+    # Reap workers once the supervisor kills them, and only keep the pids of live ones, so that
+    # taking them down with us on shutdown can't hit an unrelated process that reused a pid
+    pids = set()
+
+    def reap(*_):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            pids.discard(pid)
+
+    signal.signal(signal.SIGCHLD, reap)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+
+    try:
+        while sock.recv(1):
+            worker_sock, child_sock = socket.socketpair()
+            # Hold off reaping until the new pid is in the set, or a worker dying straight away would stay there
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+            pid = os.fork()
+            if pid == 0:
+                # In the new worker, serve snippets over our end of the socket pair
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+                sock.close()
+                worker_sock.close()
+                _worker_main(Connection(child_sock.detach()))
+                os._exit(0)
+
+            # Hand the worker's pid and its end of the socket pair back to the supervisor
+            pids.add(pid)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+            child_sock.close()
+            socket.send_fds(sock, [str(pid).encode()], [worker_sock.fileno()])
+            worker_sock.close()
+    finally:
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+class _Template:
+    """A pre-warmed process that new sandbox workers are forked from"""
+
+    def __init__(self, context):
+        self.sock, child_sock = socket.socketpair()
+        self.process = context.Process(target=_template_main, args=(child_sock, self.sock), daemon=True)
+        self.process.start()
+        child_sock.close()
+
+    def fork(self):
+        """Fork a worker from the template and return its pid and the supervisor's end of its pipe, raising
+        ConnectionError if the template has died"""
+        self.sock.sendall(b"\0")
+        pid, fds, _, _ = socket.recv_fds(self.sock, 16, 1)
+        if not fds:
+            raise ConnectionError("the template process has exited")
+        return int(pid), Connection(fds[0])
+
+    def close(self):
+        self.sock.close()
+        self.process.join()
+
+
+class _Worker:
+    """A single sandbox process and the supervisor's end of its pipe"""
+
+    def __init__(self, context, template: Optional[_Template] = None):
+        # compile cache (hits, misses) last reported by the worker
+        self.compile_counts = (0, 0)
+        # (loop, fd, future) while the supervisor waits for a reply
+        self.reader = None
+
+        if template is not None:
+            self.process = None
+            self.pid, self.conn = template.fork()
+            return
+
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        self.pid = self.process.pid
+
+        # The child keeps its own copy of its end of the pipe
+        child_conn.close()
+
+    @property
+    def alive(self) -> bool:
+        return not self.conn.closed
+
+    def kill(self):
+        """Hard-kill the process and release its pipe, doing nothing if it is already dead"""
+        if not self.alive:
+            return
+
+        # Wake whoever waits for a reply, and stop the event loop watching the fd before it is closed and reused
+        if self.reader is not None:
+            loop, fd, readable = self.reader
+            self.reader = None
+            loop.remove_reader(fd)
+            if not readable.done():
+                readable.set_result(None)
+
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+        else:
+            # Forked from the template, which reaps it
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.conn.close()
+
+        # Release the images of a snippet that never got to send its reply
+        for path in glob.glob(f"{_SHARED_MEMORY_DIR}/rubber_duck_{self.pid}_*"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SandboxPool:
+    """A supervised pool of sandbox workers that replaces any worker whose snippet overruns its deadline"""
+
+    def __init__(self, size: int = 4, timeout: float = 10, warm: bool = True, limits: Limits = Limits(),
+                 collect_images: bool = True):
+        self.size = size
+        self.timeout = timeout
+        self.limits = limits
+        # whether to read shown images out of shared memory, or leave their files for another process to read,
+        # with each result's images holding the {"path", "shape"} of the files
+        self.collect_images = collect_images
+        self._context = multiprocess.get_context("fork")
+
+        # In warm mode, workers are forked from a template that has already imported the whitelisted
+        # modules, so neither the first snippet nor a replacement worker pays the import cost
+        self._template = _Template(self._context) if warm else None
+        self._workers = set()
+        self._idle = asyncio.Queue()
+        self.kills = 0
+        self.runs = 0
+
+        # compile cache counts of workers that have since been replaced
+        self._retired_compile_counts = (0, 0)
+
+        # Start every worker up front so the first snippets don't pay for it
+        for _ in range(size):
+            self._add_worker()
+
+    def _spawn(self) -> _Worker:
+        """Start a worker, starting a new template if the old one has died, and a cold worker if that fails too"""
+        if self._template is not None:
+            try:
+                return _Worker(self._context, self._template)
+            except OSError:
+                # Most likely picked by the OOM killer, being the largest process
+                self._template.close()
+                self._template = None
+            try:
+                self._template = _Template(self._context)
+                return _Worker(self._context, self._template)
+            except OSError:
+                if self._template is not None:
+                    self._template.close()
+                    self._template = None
+        return _Worker(self._context)
+
+    def _add_worker(self):
+        worker = self._spawn()
+        self._workers.add(worker)
+        self._idle.put_nowait(worker)
+
+    def _retire_worker(self, worker: _Worker):
+        """Kill a worker for good, keeping its compile cache counts"""
+        self._workers.discard(worker)
+        worker.kill()
+        self._retired_compile_counts = tuple(
+            retired + current for retired, current in zip(self._retired_compile_counts, worker.compile_counts))
+
+    def _replace_worker(self, worker: _Worker):
+        """Kill a worker and start a fresh one in its place, unless the pool has since been shrunk"""
+        self._retire_worker(worker)
+        self.kills += 1
+        if len(self._workers) < self.size:
+            self._add_worker()
+
+    def _release_worker(self, worker: _Worker):
+        """Hand a worker that finished its snippet back to the pool, or retire it if the pool has been shrunk"""
+        if len(self._workers) > self.size:
+            self._retire_worker(worker)
+        else:
+            self._idle.put_nowait(worker)
+
+    def resize(self, size: int):
+        """Grow or shrink the pool, busy workers are only retired once they finish their snippet"""
+        self.size = size
+        while len(self._workers) < size:
+            self._add_worker()
+        while len(self._workers) > size and not self._idle.empty():
+            self._retire_worker(self._idle.get_nowait())
+
+    @property
+    def busy(self) -> int:
+        """Number of workers currently running a snippet"""
+        return len(self._workers) - self._idle.qsize()
+
+    @property
+    def worker_pids(self) -> Tuple[int, ...]:
+        """Process ids of the current workers"""
+        return tuple(worker.pid for worker in self._workers)
+
+    @property
+    def compile_cache_stats(self) -> Tuple[int, int]:
+        """Compile cache hits and misses summed over every worker the pool has run"""
+        hits, misses = self._retired_compile_counts
+        for worker in self._workers:
+            hits += worker.compile_counts[0]
+            misses += worker.compile_counts[1]
+        return hits, misses
+
+    async def _receive(self, worker: _Worker, deadline: float, on_output: Optional[Callable[[str], None]],
+                       partial: list) -> dict:
+        """Wait for the worker's final reply without blocking the event loop, passing on output as it streams in"""
+        loop = asyncio.get_running_loop()
+        conn = worker.conn
+        while True:
+            if not conn.poll():
+                readable = loop.create_future()
+                fd = conn.fileno()
+                loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+                worker.reader = (loop, fd, readable)
+                try:
+                    await asyncio.wait_for(readable, deadline - loop.time())
+                finally:
+                    # Unless the worker was killed while we waited, which already did
+                    if worker.reader is not None:
+                        worker.reader = None
+                        loop.remove_reader(fd)
+
+            message = conn.recv()
+            if "chunk" not in message:
+                return message
+            partial.append(message["chunk"])
+            if on_output is not None:
+                on_output(message["chunk"])
+
+    async def _exchange(self, worker: _Worker, request: tuple, timeout: Optional[float],
+                        on_output: Optional[Callable[[str], None]]) -> Tuple[ExecutionResult, dict]:
+        """Send a request to a worker and wait for its result and raw reply, killing the worker if it can't be
+        trusted with anything else afterwards"""
+        deadline = asyncio.get_running_loop().time() + (timeout or self.timeout)
+
+        # Whatever the snippet printed before it was stopped is still worth showing
+        partial = []
+        try:
+            worker.conn.send(request)
+            reply = await self._receive(worker, deadline, on_output, partial)
+        except asyncio.TimeoutError:
+            # The snippet is still running
+            worker.kill()
+            return ExecutionResult(output="".join(partial), timed_out=True, killed=True), {}
+        except (EOFError, OSError):
+            # The worker died while running the snippet, or was killed by whoever owns it
+            error = "the sandbox process exited unexpectedly" if worker.alive else "the sandbox process was stopped"
+            worker.kill()
+            return ExecutionResult(output="".join(partial), error=error, killed=True), {}
+        except BaseException:
+            # Cancelled mid-run, so the worker's state is unknown
+            worker.kill()
+            raise
+
+        worker.compile_counts = reply["compile_counts"]
+        images = reply.get("images", [])
+        if self.collect_images:
+            images = _collect_images(images)
+        timings = reply["timings"]
+        timings["transfer"] = max(time.time() - reply["sent_at"], 0.0)
+        if reply["status"] == "error":
+            return ExecutionResult(output="".join(partial), error=reply["output"], timings=timings,
+                                   images=images), reply
+        if reply["status"] in ("cpu", "memory"):
+            return ExecutionResult(output="".join(partial), limit=reply["status"], timings=timings,
+                                   images=images), reply
+        return ExecutionResult(output=reply["output"], truncated=reply["truncated"], timings=timings,
+                               images=images), reply
+
+    async def run(self, source: str, timeout: Optional[float] = None,
+                  on_output: Optional[Callable[[str], None]] = None) -> ExecutionResult:
+        """Run the given code on an idle worker and return its result, calling on_output with text as it is printed"""
+        worker = await self._idle.get()
+        self.runs += 1
+        try:
+            result, _ = await self._exchange(worker, ("run", source, self.limits), timeout, on_output)
+        except BaseException:
+            self._replace_worker(worker)
+            raise
+
+        if result.killed:
+            self._replace_worker(worker)
+        else:
+            self._release_worker(worker)
+        return result
+
+    def spawn_dedicated(self) -> _Worker:
+        """Start a worker that is kept out of the pool, for a caller that needs the same process every time"""
+        return self._spawn()
+
+    async def run_dedicated(self, worker: _Worker, source: str, limits: Limits, timeout: Optional[float] = None,
+                            on_output: Optional[Callable[[str], None]] = None) -> ExecutionResult:
+        """Run the given code in a dedicated worker's session namespace, which the next snippet sees again"""
+        self.runs += 1
+        result, _ = await self._exchange(worker, ("session", source, limits), timeout, on_output)
+        return result
+
+    async def inspect_dedicated(self, worker: _Worker, timeout: Optional[float] = None) -> Tuple[list, int]:
+        """The globals of a dedicated worker's session, as (name, type, preview), and the memory it has grown by"""
+        result, reply = await self._exchange(worker, ("inspect", "", self.limits), timeout, None)
+        if result.killed or result.error is not None:
+            raise RuntimeError(result.error or "the session could not be inspected in time")
+        return reply["names"], reply["memory"]
+
+    def close(self):
+        """Kill every worker in the pool"""
+        for worker in self._workers:
+            worker.kill()
+        self._workers.clear()
+
+        if self._template is not None:
+            self._template.close()
@@ -0,0 +1,141 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Hashable, Iterator, Optional
+
+from sandbox import ExecutionResult, SandboxPool
+
+
+class QueueFull(Exception):
+    """Raised when the scheduler's backlog can't take any more snippets"""
+
+
+class _Job:
+    """A queued snippet and the caller waiting on it"""
+
+    def __init__(self, source: str, on_position: Optional[Callable[[int], Awaitable[None]]],
+                 on_output: Optional[Callable[[str], None]]):
+        self.source = source
+        self.on_output = on_output
+        self.submitted = asyncio.get_running_loop().time()
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = None
+        self._reporter = None
+
+    def report_position(self, position: int):
+        """Tell the caller its position has changed, coalescing updates while one is still being sent"""
+        if self.on_position is None or position == self.position:
+            return
+
+        # A job that never waited doesn't need to be told it is running
+        if self.position is None and position == 0:
+            self.position = position
+            return
+
+        self.position = position
+        if self._reporter is None or self._reporter.done():
+            self._reporter = asyncio.ensure_future(self._report())
+
+    async def _report(self):
+        reported = None
+        while reported != self.position:
+            reported = self.position
+            try:
+                await self.on_position(reported)
+            except Exception:
+                # Position updates are best-effort, the result is what matters
+                pass
+
+    async def settle(self):
+        """Wait for the last position update to go out, so it can't overwrite the result"""
+        if self._reporter is not None:
+            await self._reporter
+
+
+class Scheduler:
+    """Hands snippets to the pool round-robin across channels, and across users within each channel"""
+
+    def __init__(self, pool: SandboxPool, backlog: int = 50):
+        self.pool = pool
+        self.backlog = backlog
+        self.running = 0
+        self.queued = 0
+
+        # channel -> user -> that user's snippets, each level in the order it is next served
+        self._channels = OrderedDict()
+
+    def _order(self) -> Iterator[_Job]:
+        """Yield the queued jobs in the order they will be dispatched"""
+        channels = deque(deque(deque(jobs) for jobs in users.values()) for users in self._channels.values())
+        while channels:
+            users = channels.popleft()
+            jobs = users.popleft()
+            yield jobs.popleft()
+            if jobs:
+                users.append(jobs)
+            if users:
+                channels.append(users)
+
+    def _pop(self) -> _Job:
+        """Take the next job, then move its user and channel to the back of their queues"""
+        channel, users = self._channels.popitem(last=False)
+        user, jobs = users.popitem(last=False)
+        job = jobs.popleft()
+        if jobs:
+            users[user] = jobs
+        if users:
+            self._channels[channel] = users
+        self.queued -= 1
+        return job
+
+    def _dispatch(self):
+        """Start queued jobs while there are free workers, then tell the rest where they stand"""
+        while self.queued and self.running < self.pool.size:
+            job = self._pop()
+            if job.future.cancelled():
+                continue
+            self.running += 1
+            job.report_position(0)
+            asyncio.ensure_future(self._run(job))
+
+        waiting = (job for job in self._order() if not job.future.cancelled())
+        for position, job in enumerate(waiting, start=1):
+            job.report_position(position)
+
+    def resize(self, size: int):
+        """Resize the pool, starting any queued jobs that now have a worker"""
+        self.pool.resize(size)
+        self._dispatch()
+
+    async def _run(self, job: _Job):
+        queue_wait = asyncio.get_running_loop().time() - job.submitted
+        try:
+            result = await self.pool.run(job.source, on_output=job.on_output)
+            result.timings["queue_wait"] = queue_wait
+        except Exception as e:
+            result = e
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+        await job.settle()
+        if job.future.cancelled():
+            return
+        if isinstance(result, Exception):
+            job.future.set_exception(result)
+        else:
+            job.future.set_result(result)
+
+    async def submit(self, source: str, user: Hashable, channel: Hashable,
+                     on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+                     on_output: Optional[Callable[[str], None]] = None) -> ExecutionResult:
+        """Queue a snippet and wait for its result, calling on_position with its place in line (0 once running)
+        and on_output with its output as it is printed"""
+        if self.queued >= self.backlog:
+            raise QueueFull(f"{self.queued} snippets are already waiting")
+
+        job = _Job(source, on_position, on_output)
+        self._channels.setdefault(channel, OrderedDict()).setdefault(user, deque()).append(job)
+        self.queued += 1
+        self._dispatch()
+        return await job.future
@@ -0,0 +1,133 @@
+import asyncio
+import dataclasses
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+from sandbox import ExecutionResult, SandboxPool
+
+
+class SessionsFull(Exception):
+    """Raised when every session worker is busy and none can be evicted to make room"""
+
+
+class _Session:
+    """A user's dedicated sandbox worker, whose globals carry over from one snippet to the next"""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.lock = asyncio.Lock()
+        self.started = asyncio.get_running_loop().time()
+        self.last_used = self.started
+        self.runs = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.worker.alive
+
+
+class SessionManager:
+    """Keeps opt-in REPL sessions in dedicated warm workers, expiring idle ones and evicting the least recently used
+    when there is no room for another"""
+
+    def __init__(self, pool: SandboxPool, capacity: int = 2, idle_timeout: float = 900,
+                 memory: Optional[int] = None, on_end: Optional[Callable[[Hashable, str], None]] = None):
+        self.pool = pool
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        # each session may grow by this much memory over all of its snippets together
+        self.limits = dataclasses.replace(pool.limits, memory=memory or pool.limits.memory)
+        self.on_end = on_end
+        self.evictions = 0
+        self.expirations = 0
+
+        # user -> session, least recently used first
+        self._sessions = OrderedDict()
+        self._task = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def active(self, user: Hashable) -> bool:
+        return user in self._sessions
+
+    def _end(self, user: Hashable, reason: str):
+        session = self._sessions.pop(user)
+        session.worker.kill()
+        if self.on_end is not None:
+            self.on_end(user, reason)
+
+    def start(self, user: Hashable):
+        """Start a session for the user, evicting the least recently used idle session if all slots are taken"""
+        if user in self._sessions:
+            return
+        if len(self._sessions) >= self.capacity:
+            idle = [other for other, session in self._sessions.items() if not session.lock.locked()]
+            if not idle:
+                raise SessionsFull(f"all {self.capacity} sessions are running a snippet")
+            self.evictions += 1
+            self._end(idle[0], "evicted to make room for another session")
+        self._sessions[user] = _Session(self.pool.spawn_dedicated())
+
+    def stop(self, user: Hashable):
+        if user in self._sessions:
+            self._end(user, "stopped")
+
+    async def reset(self, user: Hashable):
+        """Throw away the session's globals by replacing its worker, once its running snippet is done"""
+        session = self._sessions.get(user)
+        if session is None:
+            return
+        async with session.lock:
+            session.worker.kill()
+            session.worker = self.pool.spawn_dedicated()
+            session.runs = 0
+
+    async def run(self, user: Hashable, source: str,
+                  on_output: Optional[Callable[[str], None]] = None) -> ExecutionResult:
+        """Run a snippet in the user's session, one at a time per session"""
+        session = self._sessions[user]
+        self._sessions.move_to_end(user)
+        async with session.lock:
+            try:
+                result = await self.pool.run_dedicated(session.worker, source, self.limits, on_output=on_output)
+            finally:
+                session.last_used = asyncio.get_running_loop().time()
+                session.runs += 1
+
+                # A worker that overran its deadline was killed, and its globals with it
+                if not session.alive and self._sessions.get(user) is session:
+                    self._end(user, "lost when its snippet was stopped")
+        return result
+
+    async def inspect(self, user: Hashable) -> Tuple[list, int, int]:
+        """The session's globals as (name, type, preview), the memory it has grown by and its number of snippets"""
+        session = self._sessions[user]
+        async with session.lock:
+            try:
+                names, memory = await self.pool.inspect_dedicated(session.worker)
+            finally:
+                if not session.alive and self._sessions.get(user) is session:
+                    self._end(user, "lost while being inspected")
+        return names, memory, session.runs
+
+    def expire(self):
+        """End the sessions that have sat idle for longer than the idle timeout"""
+        deadline = asyncio.get_running_loop().time() - self.idle_timeout
+        for user, session in list(self._sessions.items()):
+            if session.last_used < deadline and not session.lock.locked():
+                self.expirations += 1
+                self._end(user, f"idle for more than {self.idle_timeout / 60:.0f} minutes")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 4, 60))
+            self.expire()
+
+    def start_expiry(self):
+        """Start expiring idle sessions in the background, doing nothing if it is already running"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        for user in list(self._sessions):
+            self._sessions.pop(user).worker.kill()
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import psutil
+
+from sandbox import SandboxPool
+
+# characters of a sparkline, from the lowest value to the highest
+_SPARK_LEVELS = "▁▂▃▄▅▆▇█"
+
+
+@dataclass(frozen=True)
+class Sample:
+    """The state of the bot and its host at one point in time"""
+    time: float
+    # system wide CPU usage since the previous sample
+    cpu_percent: float
+    load: Tuple[float, float, float]
+    memory_used: int
+    memory_percent: float
+    bot_rss: int
+    # resident memory of each sandbox worker
+    worker_rss: Tuple[int, ...]
+    # share of the pool's workers running a snippet
+    utilization: float
+    executions_per_minute: float
+
+
+class SystemSampler:
+    """Samples the host, the bot and its sandbox pool in the background into a fixed-size ring buffer"""
+
+    def __init__(self, pool: SandboxPool, interval: float = 5, history: int = 720):
+        self.pool = pool
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self._process = psutil.Process()
+        self._workers: Dict[int, psutil.Process] = {}
+        self._last_runs = pool.runs
+        self._last_time = time.monotonic()
+        self._task = None
+
+        # The first reading of the CPU usage only starts its measurement
+        psutil.cpu_percent(interval=None)
+
+    def _worker_rss(self) -> Tuple[int, ...]:
+        """RSS of each worker, keeping the psutil handles of workers that are still around"""
+        pids = self.pool.worker_pids
+        self._workers = {pid: self._workers.get(pid) or psutil.Process(pid) for pid in pids}
+        rss = []
+        for process in self._workers.values():
+            try:
+                rss.append(process.memory_info().rss)
+            except psutil.Error:
+                # Replaced since the pids were read
+                pass
+        return tuple(rss)
+
+    def sample(self) -> Sample:
+        """Take a sample and add it to the history"""
+        now = time.monotonic()
+        runs = self.pool.runs
+        elapsed = max(now - self._last_time, 1e-9)
+        memory = psutil.virtual_memory()
+
+        sample = Sample(time=time.time(),
+                        cpu_percent=psutil.cpu_percent(interval=None),
+                        load=os.getloadavg(),
+                        memory_used=memory.used,
+                        memory_percent=memory.percent,
+                        bot_rss=self._process.memory_info().rss,
+                        worker_rss=self._worker_rss(),
+                        utilization=self.pool.busy / self.pool.size if self.pool.size else 0.0,
+                        executions_per_minute=(runs - self._last_runs) / elapsed * 60)
+        self._last_runs, self._last_time = runs, now
+        self.samples.append(sample)
+        return sample
+
+    @property
+    def latest(self) -> Optional[Sample]:
+        return self.samples[-1] if self.samples else None
+
+    def series(self, read) -> List[float]:
+        """Values read from every sample in the history, oldest first"""
+        return [read(sample) for sample in self.samples]
+
+    async def _run(self):
+        while True:
+            try:
+                self.sample()
+            except (psutil.Error, OSError):
+                # A missed sample only leaves a gap in the history
+                pass
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start sampling in the background, doing nothing if it is already running"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+def sparkline(values: List[float], width: int = 24) -> str:
+    """Draw values as a line of block characters, averaging them down to at most width characters"""
+    if not values:
+        return ""
+
+    # Average consecutive values into one bucket per character
+    if len(values) > width:
+        buckets = [values[len(values) * i // width:len(values) * (i + 1) // width] for i in range(width)]
+        values = [sum(bucket) / len(bucket) for bucket in buckets]
+
+    low, high = min(values), max(values)
+    if high == low:
+        return _SPARK_LEVELS[0] * len(values)
+    return "".join(_SPARK_LEVELS[round((value - low) / (high - low) * (len(_SPARK_LEVELS) - 1))] for value in values)
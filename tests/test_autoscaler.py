@@ -0,0 +1,12 @@
+import autoscaler
+
+
+def test_memory_budget_leaves_out_reclaimable_page_cache(tmp_path, monkeypatch):
+    (tmp_path / "memory.max").write_text("268435456\n")
+    (tmp_path / "memory.current").write_text(f"{250 * 2 ** 20}\n")
+    (tmp_path / "memory.stat").write_text(f"anon {100 * 2 ** 20}\nfile {150 * 2 ** 20}\n"
+                                          f"active_file {30 * 2 ** 20}\ninactive_file {120 * 2 ** 20}\n")
+    monkeypatch.setattr(autoscaler, "_CGROUP_V2", (str(tmp_path / "memory.max"), str(tmp_path / "memory.current"),
+                                                   str(tmp_path / "memory.stat"), "inactive_file"))
+
+    assert autoscaler.memory_budget() == (256 * 2 ** 20, 130 * 2 ** 20)
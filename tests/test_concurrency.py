@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+
+from bench import FakeChannel, FakeMessage, FakeSentMessage, FakeUser
+from result_cache import ResultCache
+from sandbox import ExecutionResult, Limits
+
+
+class FakePool:
+    """Stands in for the sandbox pool, each snippet takes as long as the number it prints, in tenths of a second,
+    without using any CPU"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.limits = Limits()
+        self.timeout = 10
+        self.busy = 0
+
+    async def run(self, source, timeout=None, on_output=None):
+        self.busy += 1
+        try:
+            seconds = int(source.split("(")[1].split(")")[0]) / 10
+            await asyncio.sleep(seconds)
+        finally:
+            self.busy -= 1
+        return ExecutionResult(output=f"{seconds}\n", timings={"execute": seconds})
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main.log_writer, "location", str(tmp_path))
+    # Every snippet has to go through the scheduler, which would otherwise hand it to the fast path
+    monkeypatch.setattr(main, "fast_path_enabled", False)
+    # Keep earlier runs of the same snippets from being answered from the cache
+    monkeypatch.setattr(main, "results", ResultCache())
+    return main
+
+
+def test_snippets_run_concurrently(main, monkeypatch):
+    durations = [3, 5, 8, 10]
+    monkeypatch.setattr(main.scheduler, "pool", FakePool(size=len(durations)))
+
+    async def send_all():
+        messages = [FakeMessage(f">> print({tenths})", FakeUser(i), FakeChannel(i))
+                    for i, tenths in enumerate(durations)]
+        start = time.perf_counter()
+        await asyncio.gather(*(main.on_message(message) for message in messages))
+        return time.perf_counter() - start, messages
+
+    elapsed, messages = asyncio.run(send_all())
+
+    # About max(time) rather than sum(time)
+    assert max(durations) / 10 <= elapsed < sum(durations) / 10 * 0.6
+    for message, tenths in zip(messages, durations):
+        assert any(f"{tenths / 10}" in field.value for field in message.sent.embeds[-1].fields)
+
+
+
+class SlowSentMessage(FakeSentMessage):
+    """A reply whose edits queue up behind every other edit in its channel, as Discord's rate limit has them"""
+
+    async def edit(self, embed=None, **kwargs):
+        async with self.channel.edits:
+            await asyncio.sleep(0.05)
+        await super().edit(embed, **kwargs)
+
+
+class SlowMessage(FakeMessage):
+    async def reply(self, embed=None, **kwargs):
+        self.sent = SlowSentMessage(self.channel, embed)
+        return self.sent
+
+
+def test_results_dont_wait_for_position_updates(main, monkeypatch):
+    monkeypatch.setattr(main.scheduler, "pool", FakePool(size=1))
+
+    async def send_all():
+        channel = FakeChannel(0)
+        channel.edits = asyncio.Lock()
+        messages = [SlowMessage(f">> print(1)\n# {i}", FakeUser(i), channel) for i in range(12)]
+        start = time.perf_counter()
+        await asyncio.gather(*(main.on_message(message) for message in messages))
+        return time.perf_counter() - start
+
+    # Twelve snippets of 0.1s one after the other, with their result edits overlapping the next snippet, rather
+    # than each result queued behind an edit for every waiting snippet whenever one starts
+    assert asyncio.run(send_all()) < 12 * 0.1 + 0.5
@@ -0,0 +1,99 @@
+import asyncio
+
+from executor import ExecutorClient, ExecutorServer
+from sandbox import SandboxPool
+from scheduler import Scheduler
+from sessions import SessionManager
+
+
+async def start_executor(path: str):
+    pool = SandboxPool(size=1, timeout=5, collect_images=False)
+    executor = ExecutorServer(pool, Scheduler(pool))
+    server = await executor.serve(path)
+    return pool, executor, server
+
+
+async def stop_executor(pool, executor, server):
+    server.close()
+    executor.close()
+    await asyncio.sleep(0.1)
+    pool.close()
+
+
+def test_images_and_sessions_over_the_socket(tmp_path):
+    path = str(tmp_path / "executor.sock")
+
+    async def scenario():
+        executor = await start_executor(path)
+        client = ExecutorClient(path)
+        sessions = SessionManager(client, capacity=1)
+        try:
+            shown = await client.run("import numpy\nshow(numpy.full((2, 3), 7, dtype=numpy.uint8))")
+            sessions.start(1)
+            await sessions.run(1, "x = 41")
+            kept = await sessions.run(1, "print(x + 1)")
+
+            # A restarted executor has none of the old sessions' workers
+            await stop_executor(*executor)
+            executor = await start_executor(path)
+            lost = await sessions.run(1, "print(x)")
+            return shown, kept, lost, sessions.active(1)
+        finally:
+            client.close()
+            sessions.close()
+            await stop_executor(*executor)
+
+    shown, kept, lost, active = asyncio.run(scenario())
+
+    assert [(image.width, image.height, image.pixels) for image in shown.images] == [(3, 2, bytes([7] * 6))]
+    assert kept.output == "42\n"
+    assert lost.killed and "restarted" in lost.error
+    assert not active
+
+
+def test_sessions_close_with_their_bot(tmp_path):
+    path = str(tmp_path / "executor.sock")
+
+    async def scenario():
+        pool, executor, server = await start_executor(path)
+        try:
+            client = ExecutorClient(path)
+            sessions = SessionManager(client, capacity=1)
+            sessions.start(1)
+            await sessions.run(1, "x = 1")
+            opened = executor.health()["sessions"]
+            client.close()
+            await asyncio.sleep(0.1)
+            return opened, executor.health()["sessions"]
+        finally:
+            await stop_executor(pool, executor, server)
+
+    assert asyncio.run(scenario()) == (1, 0)
+
+
+def test_sessions_stopped_mid_run_free_their_worker(tmp_path):
+    path = str(tmp_path / "executor.sock")
+
+    async def scenario():
+        pool, executor, server = await start_executor(path)
+        client = ExecutorClient(path)
+        sessions = SessionManager(client, capacity=2)
+        try:
+            sessions.start(1)
+            running = asyncio.ensure_future(sessions.run(1, "while True:\n    pass"))
+            await asyncio.sleep(0.5)
+            sessions.stop(1)
+            stopped = await asyncio.wait_for(running, 2)
+
+            sessions.start(2)
+            after = await asyncio.wait_for(sessions.run(2, "print('hi')"), 2)
+            return stopped, after
+        finally:
+            client.close()
+            sessions.close()
+            await stop_executor(pool, executor, server)
+
+    stopped, after = asyncio.run(scenario())
+
+    assert stopped.killed
+    assert after.output == "hi\n"
@@ -0,0 +1,19 @@
+import time
+
+from fast_path import classify, evaluate
+
+
+def run(source: str):
+    tree = classify(source)
+    assert tree is not None
+    return evaluate(tree)
+
+
+def test_nested_repetition_goes_to_the_sandbox():
+    start = time.perf_counter()
+    assert run('a = "x" * 4096\nb = [a] * 4096\nc = [b] * 4096\nprint(c)') is None
+    assert time.perf_counter() - start < 0.5
+
+
+def test_f_string_conversions_match_python():
+    assert run("print(f\"{'é'!a} {'é'!r} {'é'!s} {'é'}\")") == f"{'é'!a} {'é'!r} {'é'!s} {'é'}\n"
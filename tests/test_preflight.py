@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+from preflight import analyze
+
+
+@pytest.mark.parametrize("source", [
+    "try:\n    while True:\n        print(stack.pop())\nexcept IndexError:\n    pass",
+    "for i in range(10 ** 10):\n    if i > 3:\n        break",
+    "print(any(i > 3 for i in range(10 ** 10)))",
+    "try:\n    import json\nexcept Exception:\n    print('no json')",
+])
+def test_snippets_that_can_finish_are_run(source):
+    assert analyze(source) is None
+
+
+@pytest.mark.parametrize("source, kind", [
+    ("while True:\n    x = 1", "loop"),
+    ("while True:\n    for j in range(3):\n        break", "loop"),
+    ("for i in range(10 ** 10):\n    x = i", "range"),
+    ("x = [i for i in range(10 ** 10)]", "range"),
+    ("import json", "import"),
+    # The sandbox raises a plain Exception for a module it doesn't allow, which this handler doesn't catch
+    ("try:\n    import json\nexcept ImportError:\n    print('no json')", "import"),
+])
+def test_snippets_bound_to_fail_are_rejected(source, kind):
+    assert analyze(source).kind == kind
+
+
+@pytest.mark.parametrize("source", [
+    "x = " + "+".join(["1"] * 1000),
+    "x = " + "*".join(["2"] * 1000),
+    # Too deep for the parser itself, the sandbox's compile reports it instead
+    "x = " + "+".join(["1"] * 5000),
+], ids=["sum", "product", "too deep to parse"])
+def test_long_constant_chains_are_folded_quickly(source):
+    start = time.perf_counter()
+    assert analyze(source) is None
+    assert time.perf_counter() - start < 0.1
+
+
+def test_too_large_constants_are_found_at_the_end_of_long_chains():
+    assert analyze("x = " + "+".join(["1"] * 1000) + "+10 ** 10 ** 10").kind == "allocation"
@@ -0,0 +1,18 @@
+import pytest
+
+from result_cache import is_deterministic
+
+
+@pytest.mark.parametrize("source", [
+    "print(random.randint(1, 1000000))",
+    "print(whrandom.random())",
+    "print(id([]))",
+    "print(hash('duck'))",
+    "import random\nprint(random.random())",
+])
+def test_varying_snippets_are_not_cached(source):
+    assert not is_deterministic(source)
+
+
+def test_math_snippets_are_cached():
+    assert is_deterministic("import math\nprint(math.factorial(20))")
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import signal
+
+from sandbox import SandboxPool
+
+
+def test_overrunning_workers_are_replaced():
+    async def overrun():
+        pool = SandboxPool(size=2, timeout=0.5)
+        try:
+            results = await asyncio.gather(*(pool.run("while True:\n    pass") for _ in range(pool.size)))
+            workers = len(pool._workers)
+            after = await pool.run("print('still here')")
+        finally:
+            pool.close()
+        return results, workers, after, pool.size
+
+    results, workers, after, size = asyncio.run(overrun())
+
+    assert all(result.timed_out and result.killed for result in results)
+    assert workers == size
+    assert after.error is None and after.output == "still here\n"
+
+
+def test_workers_are_replaced_after_the_template_dies():
+    async def overrun():
+        pool = SandboxPool(size=1, timeout=0.5)
+        try:
+            # The template is the largest process, so the likeliest one for the OOM killer to pick
+            os.kill(pool._template.process.pid, signal.SIGKILL)
+            pool._template.process.join()
+            result = await pool.run("while True:\n    pass")
+            workers = len(pool._workers)
+            after = await asyncio.wait_for(pool.run("print('still here')"), 10)
+        finally:
+            pool.close()
+        return result, workers, after, pool.size
+
+    result, workers, after, size = asyncio.run(overrun())
+
+    assert result.timed_out and result.killed
+    assert workers == size
+    assert after.output == "still here\n"
+
+
+def test_template_only_kills_live_workers_on_shutdown(monkeypatch, tmp_path):
+    log = tmp_path / "kills"
+    kill = os.kill
+
+    def logged_kill(pid, sig):
+        with open(log, "a") as file:
+            file.write(f"{os.getpid()} {pid}\n")
+        kill(pid, sig)
+
+    # The template is forked from us, so it inherits the patch
+    monkeypatch.setattr(os, "kill", logged_kill)
+
+    async def overrun():
+        pool = SandboxPool(size=1, timeout=0.5)
+        template = pool._template.process.pid
+        try:
+            killed = next(iter(pool._workers)).pid
+            await pool.run("while True:\n    pass")
+            live = next(iter(pool._workers)).pid
+            await pool.run("print('still here')")
+        finally:
+            pool.close()
+        return template, killed, live
+
+    template, killed, live = asyncio.run(overrun())
+
+    kills = [tuple(map(int, line.split())) for line in log.read_text().splitlines()]
+    assert (template, live) in kills
+    assert (template, killed) not in kills
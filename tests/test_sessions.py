@@ -0,0 +1,31 @@
+import asyncio
+
+from sandbox import SandboxPool
+from sessions import SessionManager
+
+
+def test_stopping_a_session_mid_run_ends_the_run():
+    async def stop_mid_run():
+        pool = SandboxPool(size=1, timeout=5)
+        sessions = SessionManager(pool)
+        try:
+            sessions.start("duck")
+            running = asyncio.ensure_future(sessions.run("duck", "while True:\n    pass"))
+            await asyncio.sleep(0.5)
+            sessions.stop("duck")
+            stopped = await asyncio.wait_for(running, 2)
+
+            # The next worker may well reuse the stopped one's fd
+            sessions.start("goose")
+            after = await asyncio.wait_for(sessions.run("goose", "print('hi')"), 2)
+            pooled = await asyncio.wait_for(pool.run("print('still here')"), 2)
+        finally:
+            sessions.close()
+            pool.close()
+        return stopped, after, pooled
+
+    stopped, after, pooled = asyncio.run(stop_mid_run())
+
+    assert stopped.killed and stopped.error == "the sandbox process was stopped"
+    assert after.output == "hi\n"
+    assert pooled.output == "still here\n"
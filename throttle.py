@@ -0,0 +1,47 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class ThrottledUpdate:
+    """Runs an async update at most once per interval, skipping the states in between"""
+
+    def __init__(self, update: Callable[[], Awaitable[None]], interval: float):
+        self.update = update
+        self.interval = interval
+        self._dirty = False
+        self._updating = False
+        self._last = None
+        self._task = None
+
+    def schedule(self):
+        """Ask for an update with the latest state, as soon as the interval allows"""
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            if self._last is not None:
+                await asyncio.sleep(self._last + self.interval - loop.time())
+
+            self._dirty = False
+            self._last = loop.time()
+            self._updating = True
+            try:
+                await self.update()
+            except Exception:
+                # A missed update is made up for by the next one
+                pass
+            finally:
+                self._updating = False
+
+    async def close(self):
+        """Drop any pending update and wait for one already under way, so it can't land after what follows"""
+        self._dirty = False
+        if self._task is None or self._task.done():
+            return
+        if self._updating:
+            await self._task
+        else:
+            self._task.cancel()